@@ -0,0 +1,275 @@
+"""
+CLIP-based aesthetic score model, and batched inference over dataset images.
+
+Kept separate from the CLIs so they only pay for importing torch once they actually need it.
+
+Based on https://github.com/christophschuhmann/improved-aesthetic-predictor
+"""
+
+from typing import Iterator, List, Optional, Tuple
+
+import clip
+import pytorch_lightning as pl
+import torch
+import torch.nn as nn
+import torch.utils.data
+from clip.clip import Compose
+from clip.model import CLIP
+from PIL import Image as PILImage
+from PIL import UnidentifiedImageError
+
+from dataset import Image
+from embedding_cache import EmbeddingCache, file_hash, file_hashes
+from model_registry import CLIP_MODEL, MLP_MODEL, model_path
+
+
+class MLP(pl.LightningModule):
+    def __init__(self, input_size, xcol="emb", ycol="avg_rating"):
+        super().__init__()
+        self.input_size = input_size
+        self.xcol = xcol
+        self.ycol = ycol
+        self.layers = nn.Sequential(
+            nn.Linear(self.input_size, 1024),
+            # nn.ReLU(),
+            nn.Dropout(0.2),
+            nn.Linear(1024, 128),
+            # nn.ReLU(),
+            nn.Dropout(0.2),
+            nn.Linear(128, 64),
+            # nn.ReLU(),
+            nn.Dropout(0.1),
+            nn.Linear(64, 16),
+            # nn.ReLU(),
+            nn.Linear(16, 1),
+        )
+
+    def forward(self, x):
+        return self.layers(x)
+
+    def training_step(self, batch, batch_idx):
+        x = batch[self.xcol]
+        y = batch[self.ycol].reshape(-1, 1)
+        x_hat = self.layers(x)
+        loss = nn.functional.mse_loss(x_hat, y)
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        x = batch[self.xcol]
+        y = batch[self.ycol].reshape(-1, 1)
+        x_hat = self.layers(x)
+        loss = nn.functional.mse_loss(x_hat, y)
+        return loss
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
+        return optimizer
+
+
+def normalized(a, axis=-1, order=2):
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    l2 = np.atleast_1d(np.linalg.norm(a, order, axis))
+    l2[l2 == 0] = 1
+    return a / np.expand_dims(l2, axis)
+
+
+def load_clip(device: torch.device) -> tuple[CLIP, Compose]:
+    return clip.load(str(model_path(CLIP_MODEL)), device=device)
+
+
+def load_mlp(device: torch.device) -> MLP:
+    state_dict = torch.load(model_path(MLP_MODEL), map_location="cpu")
+    mlp = MLP(768)
+    mlp.load_state_dict(state_dict)
+    mlp.eval()
+    mlp.to(device)
+
+    return mlp
+
+
+def predict_from_features(image_features: torch.Tensor, mlp: MLP, device: torch.device) -> torch.Tensor:
+    """Runs the MLP head over a batch of CLIP image features, returning one score per row."""
+    processed_features = normalized(image_features.cpu().detach().float().numpy())
+    with torch.no_grad():
+        prediction = mlp(torch.from_numpy(processed_features).to(device, dtype=torch.float32))
+    return prediction.reshape(-1).cpu()
+
+
+def get_aesthetic_score(
+    image: Image,
+    clip: CLIP,
+    mlp: MLP,
+    preprocess: Compose,
+    device: torch.device,
+    cache: Optional[EmbeddingCache] = None,
+) -> float:
+    content_hash = file_hash(image.path) if cache is not None else None
+    embedding = cache.get(content_hash, image.path) if cache is not None and content_hash is not None else None
+
+    if embedding is not None:
+        image_features = torch.from_numpy(embedding).unsqueeze(0)
+    else:
+        pil_image = PILImage.open(image.path).convert("RGB")
+        preprocessed_image = preprocess(pil_image).unsqueeze(0).to(device)
+
+        with torch.no_grad():
+            image_features = clip.encode_image(preprocessed_image)
+
+        if cache is not None and content_hash is not None:
+            # Score from the stored float16 values so cached and uncached runs agree
+            image_features = image_features.cpu().half()
+            cache.put(content_hash, image_features[0].numpy(), image.path)
+
+    return predict_from_features(image_features, mlp, device).item()
+
+
+class CPUImageEncoder:
+    """CLIP's visual tower set up for CPU inference, optionally int8-quantized or run under bf16 autocast.
+
+    Only the visual tower is kept (and copied, if quantizing), so the text tower doesn't cost any extra memory.
+    """
+
+    def __init__(self, clip_model: CLIP, quantize: bool = False, bf16: bool = False, inplace: bool = False):
+        self.visual = clip_model.visual
+        if quantize:
+            self.visual = torch.quantization.quantize_dynamic(
+                self.visual, {nn.Linear}, dtype=torch.qint8, inplace=inplace
+            )
+        self.bf16 = bf16
+
+    def encode_image(self, image: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.bf16):
+            return self.visual(image.float()).float()
+
+
+def quantize_mlp(mlp: MLP) -> MLP:
+    """Returns a copy of the MLP with its linear layers dynamically quantized to int8."""
+    return torch.quantization.quantize_dynamic(mlp, {nn.Linear}, dtype=torch.qint8)
+
+
+class PreprocessedImages(torch.utils.data.Dataset):
+    """Opens and preprocesses images for CLIP, so that it can be done in DataLoader worker processes.
+
+    Keyed by `(index, path)` pairs rather than by position, so one loader (and its workers) can be reused for any
+    list of images. Items are `(index, tensor)` pairs, with `tensor` set to None if the image couldn't be read.
+    """
+
+    def __init__(self, preprocess: Compose):
+        self.preprocess = preprocess
+
+    def __getitem__(self, key: Tuple[int, str]) -> Tuple[int, Optional[torch.Tensor]]:
+        index, path = key
+        try:
+            with PILImage.open(path) as pil_image:
+                return index, self.preprocess(pil_image.convert("RGB"))
+        # DecompressionBombError isn't an OSError, but an oversized image shouldn't stop the run any more than a
+        # corrupt one
+        except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, ValueError):
+            return index, None
+
+
+class ImageBatches:
+    """Batch sampler yielding batches of `(index, path)` keys for the images being loaded, refilled for each pass."""
+
+    def __init__(self) -> None:
+        self.batches: List[List[Tuple[int, str]]] = []
+
+    def __iter__(self) -> Iterator[List[Tuple[int, str]]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+def collate_preprocessed(
+    batch: List[Tuple[int, Optional[torch.Tensor]]]
+) -> Tuple[List[int], List[int], Optional[torch.Tensor]]:
+    """Stacks the readable images in a batch, keeping track of which indices failed."""
+    indices = [index for index, tensor in batch if tensor is not None]
+    failed = [index for index, tensor in batch if tensor is None]
+    tensors = [tensor for _, tensor in batch if tensor is not None]
+    return indices, failed, torch.stack(tensors) if tensors else None
+
+
+class ImageLoader:
+    """Loads batches of preprocessed images with a DataLoader whose worker processes are kept alive between calls, so
+    scoring many small lists of images (like the pipeline's chunks) doesn't start a new pool of workers for each."""
+
+    def __init__(self, preprocess: Compose, device: torch.device, batch_size: int = 32, num_workers: int = 4):
+        self.batch_size = batch_size
+        self.sampler = ImageBatches()
+        # Keep a few batches per worker in flight so the model never waits on decoding
+        workers = {"prefetch_factor": 4, "persistent_workers": True} if num_workers > 0 else {}
+        self.loader: Optional[torch.utils.data.DataLoader] = torch.utils.data.DataLoader(
+            PreprocessedImages(preprocess),
+            batch_sampler=self.sampler,
+            num_workers=num_workers,
+            collate_fn=collate_preprocessed,
+            pin_memory=device.type == "cuda",
+            **workers,
+        )
+
+    def load(self, images: List[Image]) -> Iterator[Tuple[List[int], List[int], Optional[torch.Tensor]]]:
+        """Yields `(indices, failed, batch)` for batches of images, as from `collate_preprocessed`."""
+        assert self.loader is not None, "ImageLoader is closed"
+        keys = [(index, str(image.path)) for index, image in enumerate(images)]
+        self.sampler.batches = [keys[start : start + self.batch_size] for start in range(0, len(keys), self.batch_size)]
+        return iter(self.loader)
+
+    def close(self) -> None:
+        # The workers shut down once nothing references the loader's iterator
+        self.loader = None
+
+
+def get_aesthetic_scores(
+    images: List[Image],
+    clip: CLIP,
+    mlp: MLP,
+    preprocess: Compose,
+    device: torch.device,
+    batch_size: int = 32,
+    num_workers: int = 4,
+    cache: Optional[EmbeddingCache] = None,
+    loader: Optional[ImageLoader] = None,
+) -> Iterator[Tuple[Image, Optional[float]]]:
+    """Scores images in batches, decoding and preprocessing them in worker processes.
+
+    If a cache is given, images whose embeddings are already cached only go through the MLP, and are yielded first.
+    Pass a `loader` to reuse its workers across calls, otherwise one is started for this call.
+    Yields `(image, score)` pairs, with `score` set to None for unreadable images.
+    """
+    hashes: List[Optional[str]] = [None] * len(images)
+    if cache is not None:
+        hashes = file_hashes([image.path for image in images])
+    cached = [i for i, content_hash in enumerate(hashes) if content_hash is not None and content_hash in cache]
+    to_encode = [i for i, content_hash in enumerate(hashes) if content_hash is None or content_hash not in cache]
+
+    # Cached embeddings only need the MLP, so score them in large batches without touching the images
+    mlp_batch_size = max(batch_size, 1024)
+    for start in range(0, len(cached), mlp_batch_size):
+        chunk = cached[start : start + mlp_batch_size]
+        embeddings = cache.get_many([hashes[i] for i in chunk], [images[i].path for i in chunk])
+        predictions = predict_from_features(torch.from_numpy(embeddings), mlp, device)
+        for index, score in zip(chunk, predictions.tolist()):
+            yield images[index], score
+
+    if not to_encode:
+        return
+    if loader is None:
+        loader = ImageLoader(preprocess, device, batch_size, num_workers)
+
+    for indices, failed, batch in loader.load([images[i] for i in to_encode]):
+        scores: dict[int, Optional[float]] = {index: None for index in failed}
+        if batch is not None:
+            with torch.no_grad():
+                image_features = clip.encode_image(batch.to(device, non_blocking=True))
+            if cache is not None:
+                image_features = image_features.cpu().half()
+                for index, embedding in zip(indices, image_features.numpy()):
+                    if (content_hash := hashes[to_encode[index]]) is not None:
+                        cache.put(content_hash, embedding, images[to_encode[index]].path)
+            predictions = predict_from_features(image_features, mlp, device)
+            scores.update(zip(indices, predictions.tolist()))
+        for index in sorted(scores):
+            yield images[to_encode[index]], scores[index]
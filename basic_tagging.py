@@ -1,15 +1,19 @@
 """CLI for adding basic tags from filenames and metadata to a dataset."""
 
 import re
-from typing import List
+from typing import Callable, Dict, List
 
 import tqdm
 import typer
 
 from dataset import DatasetDirectory, Image
+from journal import Journal, metadata_fingerprint
 
 app = typer.Typer()
 
+# Bump when the tagging functions change, so already tagged images get re-tagged
+TAGGING_VERSION = 1
+
 
 def tag_nsfw(image: Image) -> None:
     """Tag an image as nsfw if the metadata says it is."""
@@ -121,6 +125,27 @@ def tag_credit(image: Image) -> None:
         image.add_tag(f"by {credit}")
 
 
+# Taggers by option name, in the order they're applied
+TAGGERS: Dict[str, Callable[[Image], None]] = {
+    "nsfw": tag_nsfw,
+    "filename": tag_filename,
+    "subfolders": tag_subfolders,
+    "title": tag_title,
+    "categories": tag_cateories,
+    "source": tag_source,
+    "description": tag_description,
+    "subreddit": tag_subreddit,
+    "credit": tag_credit,
+}
+
+
+def apply_tags(image: Image, options: Dict[str, bool]) -> None:
+    """Runs the taggers enabled in `options` on an image."""
+    for name, tagger in TAGGERS.items():
+        if options.get(name):
+            tagger(image)
+
+
 @app.command()
 def tag(
     data_dir: str = typer.Argument(..., help="Directory containing images to process"),
@@ -134,34 +159,46 @@ def tag(
     subreddit: bool = typer.Option(False, help="Tag images with their subreddit"),
     credit: bool = typer.Option(False, help="Tag images with their credit"),
     preview: bool = typer.Option(False, "--preview", "-p", help="Print the tags instead of saving them"),
+    force: bool = typer.Option(False, help="Re-tag images that were already tagged with the same options"),
 ) -> None:
     """Add basic tags to a dataset."""
     dataset = DatasetDirectory(data_dir)
-
+    dataset.load_metadata()
+    journal = Journal(data_dir)
+    options = {
+        "nsfw": nsfw,
+        "title": title,
+        "filename": filename,
+        "subfolders": subfolders,
+        "categories": categories,
+        "source": source,
+        "description": description,
+        "subreddit": subreddit,
+        "credit": credit,
+    }
+
+    skipped = 0
     for image in tqdm.tqdm(dataset.images):
-        if nsfw:
-            tag_nsfw(image)
-        if filename:
-            tag_filename(image)
-        if subfolders:
-            tag_subfolders(image)
-        if title:
-            tag_title(image)
-        if categories:
-            tag_cateories(image)
-        if source:
-            tag_source(image)
-        if description:
-            tag_description(image)
-        if subreddit:
-            tag_subreddit(image)
-        if credit:
-            tag_credit(image)
+        already_tagged = journal.is_done(
+            image.path, "basic_tagging", TAGGING_VERSION, options, metadata_fingerprint(image.metadata)
+        )
+        if already_tagged and not force and not preview:
+            skipped += 1
+            continue
+
+        apply_tags(image, options)
 
         if preview:
             typer.echo(f"Image: {image.path} - {image.tags}")
         else:
             image.save_metadata()
+            journal.record(image.path, "basic_tagging", TAGGING_VERSION, options, metadata_fingerprint(image.metadata))
+
+    if not preview:
+        dataset.flush()
+        journal.save()
+    if skipped:
+        typer.echo(f"Skipped {skipped} images that were already tagged (use --force to re-tag them)")
 
 
 if __name__ == "__main__":
@@ -3,30 +3,153 @@ CLI that resizes all images in a directory (recursively) so that the maximum sid
 according to the --max_side_length flag and saves the output as the specified file type.
 
 Also moves any associated metadata files, and adds resolution tags from before resizing.
+
+Like make, only images whose output is missing or out of date (the source image or metadata changed, or the
+conversion options did) are converted, and --prune removes outputs whose source was deleted.
+
+Images can be converted in parallel with --jobs. JPEGs are decoded at reduced size (and other formats reduced
+with a fast box filter) before the final resize, so large images never get fully decoded and resampled.
+
+With --bucket-resolution, images are instead resized and center cropped to the closest aspect ratio bucket (sizes
+with sides a multiple of --bucket-step and about the same number of pixels as a square of that resolution), and a
+buckets.json manifest listing each bucket's images is written to the output directory, so a trainer can batch images
+of the same size together without resizing them. prepare_for_sd_training.py carries the manifest through to its
+exports.
 """
 
 import json
+import math
 import os
 import pathlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import typer
 from PIL import Image
 
+from dataset import IMAGE_EXTENSIONS
+from journal import Journal
+from metadata_store import STATE_DIR, atomic_write
+
 app = typer.Typer()
 
+# Bump when the conversion changes, so already converted images get reconverted
+CONVERT_VERSION = 1
+
+
+BUCKET_MANIFEST = "buckets.json"
+
+# How much larger than the target size images are kept when decoding at reduced size or box-reducing them, so the
+# final resize still has enough detail to resample from
+REDUCING_GAP = 2
+# Modes reduce() averages pixels of directly. Others (palette, 1 bit and 16 bit images) are converted to RGB first
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK")
+
+
+def target_size(size: Tuple[int, int], max_side_length: int) -> Tuple[int, int]:
+    """
+    The size an image should be resized to so that the maximum side length is set to the specified value.
+    """
+    width, height = size
+    if width > height:
+        return max_side_length, int(max_side_length * height / width)
+    return int(max_side_length * width / height), max_side_length
+
 
 def resize_image(image: Image.Image, max_side_length: int) -> Image.Image:
     """
     Resize an image so that the maximum side length is set to the specified value.
     """
+    return image.resize(target_size(image.size, max_side_length)).convert("RGB")
+
+
+def reduce_for_resize(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """
+    Cheaply shrink an image that's much larger than `size`, keeping it at least REDUCING_GAP times larger.
+
+    JPEGs are decoded at a reduced scale with draft() (which must be called before the image is loaded), other
+    images are reduced by an integer factor with reduce().
+    """
+    width, height = size
+    if image.format == "JPEG":
+        image.draft("RGB", (width * REDUCING_GAP, height * REDUCING_GAP))
+
+    factor = min(image.size[0] // (width * REDUCING_GAP), image.size[1] // (height * REDUCING_GAP))
+    if factor >= 2:
+        if image.mode not in REDUCIBLE_MODES:
+            image = image.convert("RGB")
+        image = image.reduce(factor)
+    return image
+
+
+def make_buckets(resolution: int, step: int = 64, max_aspect_ratio: float = 2.0) -> List[Tuple[int, int]]:
+    """
+    Sizes with sides a multiple of `step`, at most `resolution` squared pixels and aspect ratios up to
+    `max_aspect_ratio`, each as large as possible for its width.
+    """
+    buckets = []
+    pixels = resolution * resolution
+    width = step
+    while width * width / max_aspect_ratio <= pixels:
+        height = pixels // width // step * step
+        if height > 0 and max(width / height, height / width) <= max_aspect_ratio:
+            buckets.append((width, height))
+        width += step
+    return buckets
+
+
+def choose_bucket(size: Tuple[int, int], buckets: Dict[int, List[Tuple[int, int]]]) -> Tuple[int, int]:
+    """
+    The bucket with the aspect ratio closest to an image's, among the buckets of the largest resolution that
+    doesn't need upscaling the image (or the smallest resolution, if they all would).
+    """
+    width, height = size
+    resolutions = sorted(buckets)
+    resolution = max((r for r in resolutions if r * r <= width * height), default=resolutions[0])
+    aspect = math.log(width / height)
+    return min(buckets[resolution], key=lambda bucket: abs(math.log(bucket[0] / bucket[1]) - aspect))
+
+
+def resize_to_bucket(image: Image.Image, bucket: Tuple[int, int]) -> Image.Image:
+    """
+    Resize an image to cover `bucket`, then crop the overflow from its center.
+    """
     width, height = image.size
-    if width > height:
-        new_width = max_side_length
-        new_height = int(max_side_length * height / width)
-    else:
-        new_width = int(max_side_length * width / height)
-        new_height = max_side_length
-    return image.resize((new_width, new_height)).convert("RGB")
+    scale = max(bucket[0] / width, bucket[1] / height)
+    size = (max(bucket[0], round(width * scale)), max(bucket[1], round(height * scale)))
+    resized = reduce_for_resize(image, size).resize(size).convert("RGB")
+    left = (size[0] - bucket[0]) // 2
+    top = (size[1] - bucket[1]) // 2
+    return resized.crop((left, top, left + bucket[0], top + bucket[1]))
+
+
+def save_bucket_manifest(output_dir: str, sizes: Dict[str, Tuple[int, int]]) -> None:
+    """
+    Write a manifest of which images (relative to the output directory) are in each bucket.
+    """
+    buckets: Dict[Tuple[int, int], List[str]] = {}
+    for output_file, size in sizes.items():
+        buckets.setdefault(tuple(size), []).append(pathlib.Path(os.path.relpath(output_file, output_dir)).as_posix())
+    manifest = {
+        "buckets": [
+            {"width": width, "height": height, "images": sorted(images)}
+            for (width, height), images in sorted(buckets.items())
+        ]
+    }
+    with atomic_write(os.path.join(output_dir, BUCKET_MANIFEST)) as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_bucket_manifest(directory: str) -> Dict[str, Tuple[int, int]]:
+    """
+    The bucket of each image in a directory's manifest, keyed by path relative to the directory (empty if it has none).
+    """
+    try:
+        with open(os.path.join(directory, BUCKET_MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {image: (bucket["width"], bucket["height"]) for bucket in manifest["buckets"] for image in bucket["images"]}
 
 
 def add_resolution_tags(image: Image.Image, metadata: dict, low_resolution: int, high_resolution: int) -> dict:
@@ -52,6 +175,89 @@ def load_metadata(image_path: str) -> dict:
         return json.load(json_file)
 
 
+def sidecar_fingerprint(image_path: str) -> str:
+    """Size and mtime of an image's metadata file, so changed metadata is noticed without reading it."""
+    stat = os.stat(f"{image_path}.json")
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_up_to_date(input_path: str, output_file: str) -> bool:
+    """
+    Whether an output image and its metadata both exist and are newer than the source image.
+    """
+    try:
+        source_mtime = os.stat(input_path).st_mtime_ns
+        return all(os.stat(path).st_mtime_ns >= source_mtime for path in (output_file, f"{output_file}.json"))
+    except FileNotFoundError:
+        return False
+
+
+def prune_outputs(output_dir: str, expected_outputs: Set[str]) -> int:
+    """
+    Delete images (and their metadata) in the output directory that don't correspond to a source image.
+    """
+    pruned = 0
+    for root, dirs, files in os.walk(output_dir):
+        if root == output_dir and STATE_DIR in dirs:
+            dirs.remove(STATE_DIR)
+        for file in files:
+            output_file = os.path.normpath(os.path.join(root, file))
+            if not file.endswith(IMAGE_EXTENSIONS) or output_file in expected_outputs:
+                continue
+            print(f"Pruning {output_file}, its source no longer exists")
+            os.remove(output_file)
+            if os.path.exists(f"{output_file}.json"):
+                os.remove(f"{output_file}.json")
+            pruned += 1
+    return pruned
+
+
+def convert_image(
+    input_path: str,
+    output_path: str,
+    metadata: dict,
+    max_side_length: int,
+    low_resolution: int,
+    high_resolution: int,
+    buckets: Optional[Dict[int, List[Tuple[int, int]]]] = None,
+) -> Tuple[int, int]:
+    """
+    Resize a single image (to a bucket, if given buckets) and save it (and its metadata) to `output_path`, returning
+    its new size. Run in worker processes with --jobs.
+    """
+    with Image.open(input_path) as image:
+        # Resolution tags are based on the original size, so they have to be added before any reduced decoding
+        metadata = add_resolution_tags(image, metadata, low_resolution, high_resolution)
+        if buckets:
+            resized = resize_to_bucket(image, choose_bucket(image.size, buckets))
+        else:
+            size = target_size(image.size, max_side_length)
+            resized = reduce_for_resize(image, size).resize(size).convert("RGB")
+
+    resized.save(output_path)
+    with open(f"{output_path}.json", "w") as json_file:
+        json.dump(metadata, json_file)
+    return resized.size
+
+
+def run_tasks(tasks: Iterable[Tuple], jobs: int) -> Iterator[Tuple[Tuple, Future]]:
+    """
+    Run convert_image over tasks in a process pool, yielding each task with its finished future.
+
+    Only a few tasks per worker are submitted at a time, so huge datasets don't queue up millions of futures.
+    """
+    with ProcessPoolExecutor(jobs) as executor:
+        pending: Dict[Future, Tuple] = {}
+        for task in tasks:
+            pending[executor.submit(convert_image, *task)] = task
+            if len(pending) >= jobs * 4:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future
+
+
 @app.command()
 def process_dataset(
     input_dir: str = typer.Argument(..., help="Directory containing images to resize"),
@@ -60,31 +266,99 @@ def process_dataset(
     file_type: str = typer.Option("webp", help="File type to save resized images as"),
     low_resolution: int = typer.Option(768, help="Maximum side length of low resolution images"),
     high_resolution: int = typer.Option(1440, help="Maximum side length of high resolution images"),
+    force: bool = typer.Option(False, help="Convert images even if they were already converted and haven't changed"),
+    jobs: int = typer.Option(1, help="Number of processes to convert images with"),
+    prune: bool = typer.Option(False, help="Delete outputs whose source images no longer exist"),
+    bucket_resolutions: List[int] = typer.Option(
+        [], "--bucket-resolution", help="Resize images to aspect ratio buckets of about this many pixels squared "
+        "(repeatable, each image uses the largest that doesn't upscale it)"
+    ),
+    bucket_step: int = typer.Option(64, help="Bucket sides are a multiple of this"),
+    max_aspect_ratio: float = typer.Option(2.0, help="Most elongated bucket aspect ratio"),
 ):
     """
     Resize all images in a directory (recursively) so that the maximum side length is set
     according to the --max_side_length flag and saves the output as the specified file type.
     """
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if not file.endswith(("jpg", "jpeg", "png", "webp")):
-                continue
-            image = Image.open(os.path.join(root, file))
+    options = {
+        "max_side_length": max_side_length,
+        "file_type": file_type,
+        "low_resolution": low_resolution,
+        "high_resolution": high_resolution,
+    }
+    buckets = {resolution: make_buckets(resolution, bucket_step, max_aspect_ratio) for resolution in bucket_resolutions}
+    if buckets:
+        # Unlike the other options, only added when bucketing, so existing conversions aren't redone
+        options["buckets"] = {"resolutions": sorted(buckets), "step": bucket_step, "max_aspect_ratio": max_aspect_ratio}
+    # Sizes of all outputs, for the bucket manifest
+    sizes: Dict[str, Tuple[int, int]] = {}
+    journal = Journal(input_dir, state_root=output_dir)
+    fingerprints: Dict[str, str] = {}
+    expected_outputs: Set[str] = set()
+    up_to_date = 0
+
+    def find_tasks() -> Iterator[Tuple]:
+        nonlocal up_to_date
+        for root, _, files in os.walk(input_dir):
+            for file in files:
+                if not file.endswith(("jpg", "jpeg", "png", "webp")):
+                    continue
+                input_path = os.path.join(root, file)
+                output_path = os.path.join(output_dir, os.path.relpath(root, input_dir))
+                file_name = os.path.splitext(file)[0]
+                output_file = os.path.join(output_path, f"{file_name}.{file_type}")
+                expected_outputs.add(os.path.normpath(output_file))
 
-            metadata = load_metadata(os.path.join(root, file))
-            metadata = add_resolution_tags(image, metadata, low_resolution, high_resolution)
+                # Only stat the source and outputs here, metadata is only read for images that need converting
+                source_fingerprint = sidecar_fingerprint(input_path)
+                already_converted = is_up_to_date(input_path, output_file) and journal.is_done(
+                    input_path, "convert_images", CONVERT_VERSION, options, source_fingerprint
+                )
+                if already_converted and not force:
+                    up_to_date += 1
+                    if buckets:
+                        with Image.open(output_file) as output_image:  # Only reads the header
+                            sizes[output_file] = output_image.size
+                    continue
 
-            image = resize_image(image, max_side_length)
+                pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
+                fingerprints[input_path] = source_fingerprint
+                metadata = load_metadata(input_path)
+                yield input_path, output_file, metadata, max_side_length, low_resolution, high_resolution, buckets
 
-            output_path = os.path.join(output_dir, os.path.relpath(root, input_dir))
-            pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
-            file_name = os.path.splitext(file)[0]
-            image.save(os.path.join(output_path, f"{file_name}.{file_type}"))
+    def finish(input_path: str, output_file: str, size: Tuple[int, int]) -> None:
+        sizes[output_file] = size
+        journal.record(input_path, "convert_images", CONVERT_VERSION, options, fingerprints.pop(input_path))
+        print(f"Resized {os.path.basename(input_path)} and saved to {os.path.dirname(output_file)}")
 
-            with open(os.path.join(output_path, f"{file_name}.{file_type}.json"), "w") as json_file:
-                json.dump(metadata, json_file)
+    def fail(input_path: str, error: BaseException) -> None:
+        fingerprints.pop(input_path)
+        print(f"Error converting {input_path}: {error}")
 
-            print(f"Resized {file} and saved to {output_path}")
+    try:
+        if jobs <= 1:
+            for task in find_tasks():
+                try:
+                    size = convert_image(*task)
+                except Exception as e:  # pylint: disable=broad-except
+                    fail(task[0], e)
+                    continue
+                finish(task[0], task[1], size)
+        else:
+            for task, future in run_tasks(find_tasks(), jobs):
+                if (error := future.exception()) is not None:
+                    fail(task[0], error)
+                    continue
+                finish(task[0], task[1], future.result())
+    finally:
+        # Even if the run is interrupted, so the images converted so far aren't converted again
+        journal.save()
+    if buckets:
+        save_bucket_manifest(output_dir, sizes)
+        print(f"Wrote {BUCKET_MANIFEST} with {len(set(sizes.values()))} buckets")
+    print(f"{up_to_date} images were already up to date")
+    if prune:
+        print(f"Pruned {prune_outputs(output_dir, expected_outputs)} outputs")
 
 
 if __name__ == "__main__":
@@ -2,82 +2,302 @@
 
 import json
 import os
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from metadata_store import (
+    STATE_DIR,
+    MetadataStore,
+    SidecarStore,
+    atomic_write,
+    lenient_json_default,
+    open_store,
+    sidecar_path,
+    state_path,
+)
+from seen_index import SeenIndex
+from tag_index import TagIndex
+from tag_set import TagSet, TagVocabulary
+
+
+def serialize_metadata(metadata: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(metadata, sort_keys=True, default=lenient_json_default)
 
 
 class Image:
-    def __init__(self, path: Union[Path, str], subfolders: Optional[List[str]] = None):
+    def __init__(
+        self,
+        path: Union[Path, str],
+        subfolders: Optional[List[str]] = None,
+        store: Optional[MetadataStore] = None,
+        vocabulary: Optional[TagVocabulary] = None,
+        tag_index: Optional[TagIndex] = None,
+    ):
         self.path = path if isinstance(path, Path) else Path(path)
         self.subfolders = subfolders if subfolders else []
+        self.store = store if store is not None else SidecarStore()
+        self.vocabulary = vocabulary
+        # Kept up to date as tags are added and removed, if the dataset has one
+        self.tag_index = tag_index
         self._metadata: Optional[Dict[str, Any]] = None
+        # Serialized metadata as of the last load or save, to tell whether it has changed since
+        self._saved: Optional[str] = None
 
     @property
     def metadata(self) -> Dict[str, Any]:
         if self._metadata is None:
-            self._metadata = self.load_metadata()
+            self._set_loaded(self.load_metadata())
+            assert self._metadata is not None
         return self._metadata
 
+    def _set_loaded(self, metadata: Dict[str, Any]) -> None:
+        if isinstance(metadata.get("tags"), list):
+            metadata["tags"] = self._tag_set(metadata["tags"])
+        self._metadata = metadata
+        self._mark_saved()
+
+    def _mark_saved(self) -> None:
+        self._saved = serialize_metadata(self._metadata)
+
     @property
-    def tags(self):
-        if "tags" not in self.metadata:
-            self.metadata["tags"] = []
-        return self.metadata.get("tags", [])
+    def is_dirty(self) -> bool:
+        """Whether the metadata was changed since it was loaded or last saved."""
+        return self._metadata is not None and serialize_metadata(self._metadata) != self._saved
+
+    @property
+    def tags(self) -> TagSet:
+        """The image's tags, in the order they were added. Stored in the metadata as a list."""
+        tags = self.metadata.get("tags")
+        if not isinstance(tags, TagSet):
+            tags = self.metadata["tags"] = self._tag_set(tags or ())
+        return tags
 
     @tags.setter
-    def tags(self, tags: list):
-        if "tags" not in self.metadata:
-            self.metadata["tags"] = []
-        self.metadata["tags"] = tags
+    def tags(self, tags: Iterable[str]):
+        new_tags = self._tag_set(tags)
+        if self.tag_index is not None:
+            self.tag_index.set_tags(self.path, new_tags, self.metadata.get("tags") or ())
+        self.metadata["tags"] = new_tags
+
+    def _tag_set(self, tags: Iterable[str]) -> TagSet:
+        return TagSet(tags, self.vocabulary, self._tag_changed)
+
+    def _tag_changed(self, tag: str, added: bool) -> None:
+        if self.tag_index is not None:
+            self.tag_index.tag_changed(self.path, tag, added)
 
     def add_tag(self, tag: str):
-        if tag not in self.tags:
-            self.tags.append(tag)
+        self.tags.add(tag)
 
     def remove_tag(self, tag: str):
-        if tag in self.tags:
-            self.tags.remove(tag)
+        self.tags.discard(tag)
 
     @property
     def metadata_path(self) -> Path:
-        return self.path.parent / (self.path.name + ".json")
+        """Path of the image's .json sidecar (only used when the dataset stores its metadata in sidecars)."""
+        return sidecar_path(self.path)
 
     def load_metadata(self) -> Dict[str, Any]:
-        if not self.metadata_path.exists():
-            print(f"Warning: {self.metadata_path} does not exist. Creating it.")
+        metadata = self.store.load(self.path)
+        if metadata is None:
+            print(f"Warning: metadata for {self.path} does not exist. Creating it.")
             self._metadata = {}
             self.save_metadata()
-        with open(self.metadata_path, "r") as f:
-            return json.load(f)
+            return self._metadata
+        return metadata
 
-    def save_metadata(self):
-        with open(self.metadata_path, "w") as f:
-            json.dump(self.metadata, f)
+    def save_metadata(self, force: bool = False) -> bool:
+        """Saves the metadata if it changed since it was loaded (or always, with `force`). Returns whether it did."""
+        if not force and not self.is_dirty:
+            return False
+        self.store.save(self.path, self.metadata)
+        self._mark_saved()
+        return True
+
+    def delete(self):
+        """Deletes the image and its metadata."""
+        os.remove(self.path)
+        self.store.delete(self.path)
+        # Nothing left to save
+        self._mark_saved()
+        if self.tag_index is not None:
+            self.tag_index.remove_image(self.path)
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+MANIFEST = "manifest.json"
+# Directory mtimes closer than this to the scan time might still change within the same mtime tick
+# (coarse timestamps on network filesystems), so they aren't trusted on the next scan
+MANIFEST_RACE_WINDOW_NS = 2_000_000_000
 
 
 class DatasetDirectory:
-    def __init__(self, path: str):
+    """All images in a directory, recursively.
+
+    By default the directory is scanned up front. With `lazy=True`, images are instead discovered as the dataset is
+    iterated, so processing starts on the first file (anything needing the full list, like `len()`, finishes the scan).
+
+    Unless `use_manifest=False`, each directory's listing is saved to a manifest in the dataset's state directory, and
+    reused on later scans for directories whose mtime hasn't changed since.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        store: Optional[MetadataStore] = None,
+        lazy: bool = False,
+        use_manifest: bool = True,
+    ):
         self.path = path
-        self.images = self.get_images()
+        self.store = store if store is not None else open_store(path)
+        self.use_manifest = use_manifest
+        # Tag strings shared by every image in the dataset
+        self.vocabulary = TagVocabulary()
+        self.tag_index: Optional[TagIndex] = TagIndex.load(path) if TagIndex.exists(path) else None
+        self._seen: Optional[SeenIndex] = None
+        self._images: Optional[List[Image]] = None
+        # Images yielded so far while streaming, before the full list is known
+        self._streamed: List[Image] = []
+        if not lazy:
+            self._images = self.get_images()
+
+    @property
+    def images(self) -> List[Image]:
+        if self._images is None:
+            self._images = self.get_images()
+        return self._images
+
+    @images.setter
+    def images(self, images: List[Image]):
+        self._images = images
+
+    @property
+    def seen(self) -> SeenIndex:
+        """Keys of everything scraped into the dataset, including images deleted since (loaded on first use)."""
+        if self._seen is None:
+            self._seen = SeenIndex(self.path)
+        return self._seen
 
     def get_images(self) -> List[Image]:
         """Fetches all images in the dataset directory recursively."""
-        images = []
-        for root, _, files in os.walk(self.path):
-            for file in files:
-                if not file.endswith((".jpg", ".jpeg", ".png", ".webp")):
+        return list(self.iter_images())
+
+    def load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        if not self.use_manifest:
+            return {}
+        try:
+            with open(Path(self.path) / STATE_DIR / MANIFEST, "r") as f:
+                return json.load(f)["directories"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save_manifest(self, directories: Dict[str, Dict[str, Any]]) -> None:
+        try:
+            with atomic_write(state_path(self.path, MANIFEST)) as f:
+                json.dump({"directories": directories}, f)
+        except OSError as e:
+            print(f"Warning: couldn't save manifest for {self.path}: {e}")
+
+    def scan_directory(self, directory: str) -> Dict[str, Any]:
+        """Lists the images and subdirectories directly inside a directory."""
+        images: List[str] = []
+        subdirectories: List[str] = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.name)
+                elif entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                    images.append(entry.name)
+        return {"images": images, "subdirectories": subdirectories}
+
+    def iter_images(self) -> Iterator[Image]:
+        """Yields all images in the dataset directory recursively, as they're found.
+
+        Directories listed in the manifest with an unchanged mtime aren't rescanned.
+        """
+        manifest = self.load_manifest()
+        new_manifest: Dict[str, Dict[str, Any]] = {}
+        scan_started = time.time_ns()
+        changed = False
+
+        pending = [""]
+        while pending:
+            relative_directory = pending.pop()
+            directory = os.path.join(self.path, relative_directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            listing = manifest.get(relative_directory)
+            if listing is None or listing["mtime_ns"] != mtime_ns or listing.get("racy"):
+                try:
+                    listing = self.scan_directory(directory)
+                except FileNotFoundError:
                     continue
-                subfolders = list(Path(root).relative_to(self.path).parts)
-                images.append(Image(Path(root) / file, subfolders))
-        return images
+                if relative_directory == "" and STATE_DIR in listing["subdirectories"]:
+                    listing["subdirectories"].remove(STATE_DIR)
+                listing["mtime_ns"] = mtime_ns
+                if mtime_ns >= scan_started - MANIFEST_RACE_WINDOW_NS:
+                    listing["racy"] = True
+                changed = True
+            new_manifest[relative_directory] = listing
+
+            subfolders = list(Path(relative_directory).parts)
+            for name in listing["images"]:
+                yield Image(Path(directory) / name, subfolders, self.store, self.vocabulary, self.tag_index)
+            # Reversed so directories come off the stack in listing order
+            pending.extend(
+                os.path.join(relative_directory, subdirectory) for subdirectory in reversed(listing["subdirectories"])
+            )
+
+        if self.use_manifest and (changed or new_manifest.keys() != manifest.keys()):
+            self.save_manifest(new_manifest)
 
-    def create_image(self, data: bytes, file_name: str, metadata: dict[str, Any]) -> Image:
+    def load_metadata(self, images: Optional[List[Image]] = None) -> None:
+        """Loads the metadata of many images in one bulk read, rather than one read per image."""
+        images = [image for image in (images if images is not None else self.images) if image._metadata is None]
+        loaded = self.store.load_many(image.path for image in images)
+        for image in images:
+            if image.path in loaded:
+                image._set_loaded(loaded[image.path])
+
+    def save_metadata(self, images: Optional[List[Image]] = None) -> int:
+        """Saves the metadata of the changed images among many in one bulk write (a single transaction if the store
+        supports it, otherwise from a thread pool). Returns the number of images saved."""
+        images = images if images is not None else self.images
+        dirty = [image for image in images if image.is_dirty]
+        if dirty:
+            self.store.save_many((image.path, image.metadata) for image in dirty)
+        for image in dirty:
+            image._mark_saved()
+        return len(dirty)
+
+    def flush(self) -> int:
+        """Saves all pending changes to the metadata of images seen so far (and the tag index, if the dataset has
+        one), without finishing a lazy scan."""
+        saved = self.save_metadata(self._images if self._images is not None else self._streamed)
+        if self.tag_index is not None:
+            self.tag_index.save()
+        return saved
+
+    def create_image(
+        self, data: bytes, file_name: str, metadata: dict[str, Any], seen_key: Optional[str] = None
+    ) -> Image:
+        """Saves a new image and its metadata to the dataset, marking `seen_key` (if given) as downloaded."""
         print(f"Saving {file_name} to {Path(self.path) / file_name}")
         with open(Path(self.path) / file_name, "wb") as f:
             f.write(data)
-        with open(Path(self.path) / (file_name + ".json"), "w") as f:
-            json.dump(metadata, f)
-        image = Image(Path(self.path) / file_name)
+        image = Image(
+            Path(self.path) / file_name, store=self.store, vocabulary=self.vocabulary, tag_index=self.tag_index
+        )
+        image._metadata = metadata
+        image.save_metadata(force=True)
+        if self.tag_index is not None:
+            self.tag_index.set_tags(image.path, metadata.get("tags") or (), ())
+        if seen_key is not None:
+            self.seen.add(seen_key)
         self.images.append(image)
 
         return image
@@ -92,4 +312,13 @@ class DatasetDirectory:
         return len(self.images)
 
     def __iter__(self):
-        return iter(self.images)
+        if self._images is not None:
+            return iter(self._images)
+        return self._stream_images()
+
+    def _stream_images(self) -> Iterator[Image]:
+        self._streamed = []
+        for image in self.iter_images():
+            self._streamed.append(image)
+            yield image
+        self._images, self._streamed = self._streamed, []
@@ -0,0 +1,110 @@
+"""
+Shared HTTP download engine for the scrapers.
+
+Requests go through a semaphore bounding how many run at once, and are spaced out per host to at most
+`requests_per_second`. Timeouts, connection errors, 429s and 5xx responses are retried with exponential backoff
+(honouring Retry-After, and slowing down the whole host on a 429). Other responses are returned as they are, for the
+caller to check the status of.
+"""
+
+import asyncio
+import json
+import random
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+import typer
+from multidict import CIMultiDict
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class Download:
+    url: str
+    status: int
+    # Case insensitive, like the response's
+    headers: Mapping[str, str]
+    body: bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class Downloader:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        concurrency: int = 16,
+        requests_per_second: Optional[float] = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.session = session
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Earliest time (on the event loop's clock) the next request to each host may start
+        self._next_request: Dict[str, float] = {}
+
+    async def _wait_for_host(self, host: str) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._next_request.get(host, now))
+        # Reserved before sleeping, so concurrent requests to the same host queue up behind each other
+        self._next_request[host] = start + (1 / self.requests_per_second if self.requests_per_second else 0)
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def _delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # Full jitter, so requests that failed together don't all retry together
+        return random.uniform(0, min(self.backoff * 2**attempt, self.max_backoff))
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> Optional[Download]:
+        """Makes a request, retrying it if it fails in a way that might not happen again.
+
+        Returns None if it still failed after all retries."""
+        host = urlsplit(url).netloc
+        for attempt in range(self.retries + 1):
+            status: Optional[int] = None
+            retry_after: Optional[str] = None
+            try:
+                await self._wait_for_host(host)
+                async with self.semaphore:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        if response.status not in RETRY_STATUSES:
+                            return Download(url, response.status, CIMultiDict(response.headers), await response.read())
+                        status = response.status
+                        error = f"status {status}"
+                        retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            if attempt == self.retries:
+                typer.echo(f"Giving up on {url} after {attempt + 1} attempts - {error}")
+                return None
+            delay = self._delay(attempt, retry_after)
+            if status == 429:
+                # Being throttled, so hold back every request to the host rather than just this one
+                loop = asyncio.get_running_loop()
+                self._next_request[host] = max(self._next_request.get(host, 0), loop.time() + delay)
+            typer.echo(f"Retrying {url} in {delay:.1f}s - {error}")
+            await asyncio.sleep(delay)
+        return None
+
+    async def get(self, url: str, **kwargs: Any) -> Optional[Download]:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> Optional[Download]:
+        return await self.request("POST", url, **kwargs)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+On-disk store for CLIP image embeddings, keyed by image content hash.
+
+Embeddings are kept in a memory-mapped float16 matrix with a JSON index mapping each content hash to its row and to
+the paths it was last seen at. Because entries are keyed by content rather than path, moved or renamed images (e.g.
+by convert_images.py) still hit the cache.
+
+The index is saved every SAVE_INTERVAL_SECONDS as well as on exit, and rows freed by eviction aren't reused until
+an index no longer referencing them is saved, so after a crash the index on disk always matches the rows it points
+to. The cache directory is locked while in use, so concurrent runs can't overwrite each other's rows: a run that
+finds it busy either waits for it, or (when scoring, via `open_cache`) goes ahead without the cache.
+
+Also a CLI for pruning embeddings whose images no longer exist.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import numpy as np
+import typer
+
+from metadata_store import atomic_write
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "data-prep" / "embeddings"
+SAVE_INTERVAL_SECONDS = 60
+
+app = typer.Typer()
+
+
+def file_hash(file_path: Union[Path, str]) -> str:
+    """Get the SHA-256 hash of a file's contents."""
+    with open(file_path, "rb") as f:
+        hasher = hashlib.sha256()
+        while chunk := f.read(1 << 20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def file_hashes(file_paths: Iterable[Union[Path, str]], workers: int = 8) -> List[Optional[str]]:
+    """Hash many files in a thread pool, returning None for files that can't be read."""
+
+    def try_hash(file_path: Union[Path, str]) -> Optional[str]:
+        try:
+            return file_hash(file_path)
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(try_hash, file_paths))
+
+
+class CacheBusyError(RuntimeError):
+    pass
+
+
+class EmbeddingCache:
+    """Memory-mapped float16 embedding matrix with a content hash -> row index.
+
+    Each model gets its own subdirectory of `cache_dir`, so embeddings from different models never mix. If
+    `max_entries` is set, inserting into a full cache first evicts entries whose images no longer exist, then the
+    least recently used entries.
+
+    Raises CacheBusyError if another process has the cache open, unless `wait` is set.
+    """
+
+    def __init__(
+        self, cache_dir: Union[Path, str], model_name: str, dim: int = 768, max_entries: int = 0, wait: bool = False
+    ):
+        self.directory = Path(cache_dir) / re.sub(r"[^A-Za-z0-9_.-]+", "-", model_name)
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max_entries
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.directory / "lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                self._lock_file.close()
+                raise CacheBusyError(f"{self.directory} is in use by another process") from None
+            typer.echo(f"Waiting for another process to finish with {self.directory}", err=True)
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self.index = self._load_index()
+        self._matrix = self._open_matrix(self.index["capacity"])
+        # Rows freed since the last save, which the saved index may still point to
+        self._released_rows: List[int] = []
+        self._last_save = time.monotonic()
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / "index.json"
+
+    @property
+    def matrix_path(self) -> Path:
+        return self.directory / "embeddings.f16"
+
+    @property
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        return self.index["entries"]
+
+    def _load_index(self) -> Dict[str, Any]:
+        if not self.index_path.exists():
+            return {"model": self.model_name, "dim": self.dim, "capacity": 0, "clock": 0, "entries": {}, "free": []}
+        with open(self.index_path, "r") as f:
+            index = json.load(f)
+        if index["model"] != self.model_name or index["dim"] != self.dim:
+            raise ValueError(
+                f"{self.directory} holds {index['model']} embeddings of size {index['dim']}, "
+                f"not {self.model_name} embeddings of size {self.dim}"
+            )
+        return index
+
+    def _open_matrix(self, capacity: int) -> Optional[np.memmap]:
+        if capacity == 0:
+            return None
+        mode = "r+" if self.matrix_path.exists() else "w+"
+        return np.memmap(self.matrix_path, dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+
+    def _grow(self, capacity: int) -> None:
+        old_capacity = self.index["capacity"]
+        if self._matrix is not None:
+            self._matrix.flush()
+            del self._matrix
+        with open(self.matrix_path, "ab") as f:
+            f.truncate(capacity * self.dim * np.dtype(np.float16).itemsize)
+        self.index["capacity"] = capacity
+        # Free rows are popped from the end, so keep the lowest rows last
+        self.index["free"] = list(range(capacity - 1, old_capacity - 1, -1)) + self.index["free"]
+        self._matrix = self._open_matrix(capacity)
+
+    def _touch(self, entry: Dict[str, Any]) -> None:
+        self.index["clock"] += 1
+        entry["used"] = self.index["clock"]
+
+    def _allocate_row(self) -> int:
+        if self.max_entries and len(self.entries) >= self.max_entries:
+            self.prune()
+            if len(self.entries) >= self.max_entries:
+                # Evict a chunk at a time so a full cache doesn't rescan for every insert
+                self.evict(len(self.entries) - self.max_entries + max(1, self.max_entries // 10))
+            # Makes the freed rows reusable, rather than growing the matrix
+            self.save()
+        if not self.index["free"]:
+            self._grow(max(1024, self.index["capacity"] * 2))
+        return self.index["free"].pop()
+
+    def __contains__(self, content_hash: str) -> bool:
+        return content_hash in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """The memory-mapped embedding matrix, indexed by `row()`."""
+        if self._matrix is None:
+            return np.empty((0, self.dim), dtype=np.float16)
+        return self._matrix
+
+    def row(self, content_hash: str) -> int:
+        return self.entries[content_hash]["row"]
+
+    def get(self, content_hash: str, path: Optional[Union[Path, str]] = None) -> Optional[np.ndarray]:
+        """Returns the embedding for a content hash (or None), recording `path` as a location of that content."""
+        entry = self.entries.get(content_hash)
+        if entry is None or self._matrix is None:
+            return None
+        if path is not None and str(path) not in entry["paths"]:
+            entry["paths"].append(str(path))
+        self._touch(entry)
+        return np.array(self._matrix[entry["row"]])
+
+    def get_many(self, content_hashes: List[str], paths: Optional[List[Union[Path, str]]] = None) -> np.ndarray:
+        """Returns the embeddings for several cached content hashes as one matrix."""
+        if not content_hashes or self._matrix is None:
+            return np.empty((0, self.dim), dtype=np.float16)
+        for i, content_hash in enumerate(content_hashes):
+            entry = self.entries[content_hash]
+            if paths is not None and str(paths[i]) not in entry["paths"]:
+                entry["paths"].append(str(paths[i]))
+            self._touch(entry)
+        return self._matrix[[self.row(content_hash) for content_hash in content_hashes]]
+
+    def put(self, content_hash: str, embedding: np.ndarray, path: Optional[Union[Path, str]] = None) -> None:
+        """Stores the embedding for a content hash, replacing any previous one."""
+        entry = self.entries.get(content_hash)
+        if entry is None:
+            entry = {"row": self._allocate_row(), "paths": []}
+            self.entries[content_hash] = entry
+        if path is not None and str(path) not in entry["paths"]:
+            entry["paths"].append(str(path))
+        self._touch(entry)
+        self._matrix[entry["row"]] = embedding.astype(np.float16).reshape(self.dim)
+        if time.monotonic() - self._last_save > SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def remove(self, content_hash: str) -> None:
+        entry = self.entries.pop(content_hash)
+        self._released_rows.append(entry["row"])
+
+    def prune(self) -> int:
+        """Evicts embeddings whose images no longer exist at any recorded path. Returns the number evicted."""
+        evicted = 0
+        for content_hash, entry in list(self.entries.items()):
+            entry["paths"] = [path for path in entry["paths"] if os.path.exists(path)]
+            if not entry["paths"]:
+                self.remove(content_hash)
+                evicted += 1
+        return evicted
+
+    def evict(self, count: int) -> None:
+        """Evicts the `count` least recently used embeddings."""
+        by_use = sorted(self.entries.items(), key=lambda item: item[1].get("used", 0))
+        for content_hash, _ in by_use[:count]:
+            self.remove(content_hash)
+
+    def save(self) -> None:
+        """Flushes the matrix and atomically rewrites the index."""
+        if self._matrix is not None:
+            self._matrix.flush()
+        # Once the index is saved without them, rows freed since the last save are safe to overwrite
+        self.index["free"].extend(self._released_rows)
+        self._released_rows = []
+        with atomic_write(self.index_path, fsync=True) as f:
+            json.dump(self.index, f)
+        self._last_save = time.monotonic()
+
+    def close(self) -> None:
+        """Saves the cache and releases its lock."""
+        if self._lock_file.closed:
+            return
+        self.save()
+        self._lock_file.close()
+
+    def __enter__(self) -> "EmbeddingCache":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def open_cache(cache_dir: Union[Path, str], model_name: str, max_entries: int = 0) -> Optional[EmbeddingCache]:
+    """Opens the cache for scoring, or returns None (to score without it) if another process is using it."""
+    try:
+        return EmbeddingCache(cache_dir, model_name, max_entries=max_entries)
+    except CacheBusyError as e:
+        typer.echo(f"Warning: {e}, so embeddings won't be cached by this run", err=True)
+        return None
+
+
+@app.command()
+def prune(
+    cache_dir: str = typer.Argument(str(DEFAULT_CACHE_DIR), help="Embedding cache directory"),
+    model_name: str = typer.Option("ViT-L/14", help="CLIP model the embeddings were computed with"),
+    dim: int = typer.Option(768, help="Size of the embeddings"),
+) -> None:
+    """Remove cached embeddings whose images no longer exist."""
+    with EmbeddingCache(cache_dir, model_name, dim, wait=True) as cache:
+        evicted = cache.prune()
+        typer.echo(f"Evicted {evicted} embeddings, {len(cache)} remaining")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,96 @@
+"""Record of which processing steps have been applied to which images, so reruns can skip work that's already done."""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from metadata_store import STATE_DIR, atomic_write, lenient_json_default, state_path
+
+JOURNAL = "journal.json"
+SAVE_INTERVAL_SECONDS = 60
+
+
+def options_key(options: Dict[str, Any]) -> str:
+    """Short, stable hash of a step's options."""
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def fingerprint(path: Union[Path, str], extra: str = "") -> List[Any]:
+    """Cheap fingerprint of a file's content (size and mtime), plus anything else the output depends on."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, hashlib.sha1(extra.encode()).hexdigest()[:16] if extra else ""]
+
+
+def metadata_fingerprint(metadata: Dict[str, Any]) -> str:
+    """Stable serialization of an image's metadata, for steps whose output depends on it."""
+    return json.dumps(metadata, sort_keys=True, default=lenient_json_default)
+
+
+class Journal:
+    """Per-image record of the steps (name, version and options) applied to each image, and its fingerprint then.
+
+    Images are keyed by their path relative to `root`. The journal itself is stored in the state directory of
+    `state_root` (by default `root`), so steps that write elsewhere can keep their journal with their output.
+    """
+
+    def __init__(self, root: Union[Path, str], state_root: Optional[Union[Path, str]] = None):
+        self.root = Path(root)
+        self.state_root = Path(state_root) if state_root is not None else self.root
+        self.entries: Dict[str, Dict[str, Dict[str, Any]]] = self._load()
+        self._last_save = time.monotonic()
+
+    def _load(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        try:
+            with open(self.state_root / STATE_DIR / JOURNAL, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def key(self, path: Union[Path, str]) -> str:
+        return Path(os.path.relpath(path, self.root)).as_posix()
+
+    def is_done(
+        self, path: Union[Path, str], step: str, version: int, options: Dict[str, Any], extra: str = ""
+    ) -> bool:
+        """Whether `step` was already applied to the image, with the same version and options, since it last changed."""
+        record = self.entries.get(self.key(path), {}).get(step)
+        if record is None or record["version"] != version or record["options"] != options_key(options):
+            return False
+        try:
+            return record["fingerprint"] == fingerprint(path, extra)
+        except FileNotFoundError:
+            return False
+
+    def record(
+        self, path: Union[Path, str], step: str, version: int, options: Dict[str, Any], extra: str = ""
+    ) -> None:
+        """Records that `step` was applied to the image. Saved every so often, and when the journal is closed."""
+        self.entries.setdefault(self.key(path), {})[step] = {
+            "version": version,
+            "options": options_key(options),
+            "fingerprint": fingerprint(path, extra),
+        }
+        if time.monotonic() - self._last_save > SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def forget(self, path: Union[Path, str], step: Optional[str] = None) -> None:
+        """Removes the record of one step (or all steps) for an image."""
+        key = self.key(path)
+        if step is None:
+            self.entries.pop(key, None)
+        else:
+            self.entries.get(key, {}).pop(step, None)
+
+    def save(self) -> None:
+        with atomic_write(state_path(self.state_root, JOURNAL)) as f:
+            json.dump(self.entries, f)
+        self._last_save = time.monotonic()
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.save()
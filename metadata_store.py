@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Backends for storing image metadata.
+
+By default each image's metadata lives in a `<image>.json` sidecar next to it. For large datasets (or network
+filesystems) it can instead be consolidated into a single SQLite database in the dataset's state directory, which
+`DatasetDirectory` picks up automatically. Also a CLI for converting between the two layouts.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import tqdm
+import typer
+
+from tag_set import TagSet
+
+# Hidden directory in the root of a dataset holding its bookkeeping files (metadata database, manifest, ...)
+STATE_DIR = ".dataset"
+METADATA_DB = "metadata.sqlite"
+# Keys per `IN (...)` query, below SQLite's default limit on bound parameters in older versions (999)
+SQLITE_BATCH_SIZE = 500
+# Past this many keys, one scan of the table is faster than looking each of them up
+SQLITE_SCAN_THRESHOLD = 20000
+
+app = typer.Typer()
+
+
+def json_default(value: Any) -> Any:
+    """Serializes the types metadata can hold that json doesn't support itself (tags are stored as a plain list)."""
+    if isinstance(value, TagSet):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def lenient_json_default(value: Any) -> Any:
+    """Like `json_default`, but falls back to str() for anything else. For comparing metadata, not storing it."""
+    return value.to_list() if isinstance(value, TagSet) else str(value)
+
+
+def state_path(root: Union[Path, str], name: str) -> Path:
+    """Path of one of a dataset's bookkeeping files, creating the directory it lives in."""
+    (Path(root) / STATE_DIR).mkdir(exist_ok=True)
+    return Path(root) / STATE_DIR / name
+
+
+def current_umask() -> int:
+    # Only readable by setting it, so this is done once at import rather than from save_many's threads
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = current_umask()
+
+
+@contextmanager
+def atomic_write(path: Union[Path, str], mode: str = "w", fsync: bool = False) -> Iterator[IO[Any]]:
+    """Opens a temporary file next to `path` to write to, which replaces `path` once the block finishes.
+
+    An interrupted write never leaves a truncated file behind, and if the block raises, the temporary file is removed
+    and `path` is left as it was. The file keeps the permissions `path` already had (or gets those a plain open()
+    would give it). With `fsync`, the data is on disk before it replaces `path`.
+    """
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            # mkstemp creates the file as 0600
+            try:
+                os.fchmod(fd, os.stat(path).st_mode & 0o7777)
+            except FileNotFoundError:
+                os.fchmod(fd, 0o666 & ~UMASK)
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(fd)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def sidecar_path(image_path: Path) -> Path:
+    return image_path.parent / (image_path.name + ".json")
+
+
+class MetadataStore:
+    """Loads and saves metadata for images, keyed by image path."""
+
+    def load(self, image_path: Path) -> Optional[Dict[str, Any]]:
+        """Returns an image's metadata, or None if it has none."""
+        raise NotImplementedError
+
+    def save(self, image_path: Path, metadata: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def delete(self, image_path: Path) -> None:
+        raise NotImplementedError
+
+    def signatures(self, image_paths: Iterable[Path]) -> Dict[Path, List[int]]:
+        """Cheap markers of the metadata of several images, which change whenever it's saved, so indexes can tell
+        which images changed without loading them. Images without one (no metadata, or a store that can't tell) are
+        omitted, and should be treated as changed."""
+        return {}
+
+    def load_many(self, image_paths: Iterable[Path]) -> Dict[Path, Dict[str, Any]]:
+        """Returns the metadata of several images at once, omitting images that have none."""
+        metadata = {}
+        for image_path in image_paths:
+            if (image_metadata := self.load(image_path)) is not None:
+                metadata[image_path] = image_metadata
+        return metadata
+
+    def save_many(self, items: Iterable[Tuple[Path, Dict[str, Any]]]) -> None:
+        """Saves the metadata of several images at once."""
+        for image_path, metadata in items:
+            self.save(image_path, metadata)
+
+    def close(self) -> None:
+        pass
+
+
+class SidecarStore(MetadataStore):
+    """Stores each image's metadata in a `<image>.json` file next to it.
+
+    Files are written with `atomic_write`, so an interrupted write never leaves a truncated sidecar behind.
+    `save_many` writes from a thread pool, since most of the time goes into waiting on the filesystem.
+    """
+
+    def __init__(self, workers: int = 8):
+        self.workers = workers
+
+    def load(self, image_path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(sidecar_path(image_path), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, image_path: Path, metadata: Dict[str, Any]) -> None:
+        with atomic_write(sidecar_path(image_path)) as f:
+            json.dump(metadata, f, default=json_default)
+
+    def signatures(self, image_paths: Iterable[Path]) -> Dict[Path, List[int]]:
+        signatures = {}
+        for image_path in image_paths:
+            try:
+                stat = os.stat(sidecar_path(image_path))
+            except FileNotFoundError:
+                continue
+            signatures[image_path] = [stat.st_size, stat.st_mtime_ns]
+        return signatures
+
+    def save_many(self, items: Iterable[Tuple[Path, Dict[str, Any]]]) -> None:
+        items = list(items)
+        if len(items) <= 1 or self.workers <= 1:
+            super().save_many(items)
+            return
+        with ThreadPoolExecutor(self.workers) as executor:
+            # Consume the results so the first error is raised
+            list(executor.map(lambda item: self.save(*item), items))
+
+    def delete(self, image_path: Path) -> None:
+        try:
+            os.remove(sidecar_path(image_path))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteStore(MetadataStore):
+    """Stores all metadata for a dataset in a single SQLite database, keyed by path relative to the dataset root.
+
+    The database runs in WAL mode so readers don't block the writer, and `save_many` writes in one transaction.
+    Every save stamps its rows with a new version from a persistent counter, which serves as their signature.
+    """
+
+    def __init__(self, root: Union[Path, str], db_path: Optional[Union[Path, str]] = None):
+        self.root = Path(root)
+        self.db_path = Path(db_path) if db_path else state_path(self.root, METADATA_DB)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(metadata)")]
+        if "version" not in columns:
+            # Databases from before versions existed start at 0, so their rows are reindexed once
+            self._connection.execute("ALTER TABLE metadata ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        # Separate from the rows, so a deleted and re-saved row can never get its old version back
+        self._connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('version', 0)")
+
+    def key(self, image_path: Path) -> str:
+        return Path(os.path.relpath(image_path, self.root)).as_posix()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def load(self, image_path: Path) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM metadata WHERE path = ?", (self.key(image_path),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, image_path: Path, metadata: Dict[str, Any]) -> None:
+        self.save_many([(image_path, metadata)])
+
+    def delete(self, image_path: Path) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM metadata WHERE path = ?", (self.key(image_path),))
+
+    def _select(self, column: str, image_paths: Iterable[Path]) -> Dict[Path, Any]:
+        """Reads one column of the rows of several images."""
+        paths_by_key = {self.key(image_path): image_path for image_path in image_paths}
+        keys = list(paths_by_key)
+        rows: List[Tuple[str, Any]] = []
+        with self._lock:
+            if len(keys) > SQLITE_SCAN_THRESHOLD:
+                rows = self._connection.execute(f"SELECT path, {column} FROM metadata").fetchall()
+                return {paths_by_key[key]: value for key, value in rows if key in paths_by_key}
+            # Only the requested rows, looked up by primary key, so loading a chunk costs the same in any size table
+            for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+                batch = keys[start : start + SQLITE_BATCH_SIZE]
+                rows.extend(
+                    self._connection.execute(
+                        f"SELECT path, {column} FROM metadata WHERE path IN ({','.join('?' * len(batch))})", batch
+                    )
+                )
+        return {paths_by_key[key]: value for key, value in rows}
+
+    def load_many(self, image_paths: Iterable[Path]) -> Dict[Path, Dict[str, Any]]:
+        return {image_path: json.loads(data) for image_path, data in self._select("data", image_paths).items()}
+
+    def signatures(self, image_paths: Iterable[Path]) -> Dict[Path, List[int]]:
+        return {image_path: [version] for image_path, version in self._select("version", image_paths).items()}
+
+    def save_many(self, items: Iterable[Tuple[Path, Dict[str, Any]]]) -> None:
+        rows = [(self.key(image_path), json.dumps(metadata, default=json_default)) for image_path, metadata in items]
+        with self.transaction() as connection:
+            # Bumped before reading, so the write lock is held and concurrent writers can't get the same version
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'version'")
+            (version,) = connection.execute("SELECT value FROM counters WHERE name = 'version'").fetchone()
+            connection.executemany(
+                "INSERT OR REPLACE INTO metadata (path, data, version) VALUES (?, ?, ?)",
+                [(key, data, version) for key, data in rows],
+            )
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT path FROM metadata")]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def open_store(root: Union[Path, str]) -> MetadataStore:
+    """Opens the SQLite store for a dataset if it has one, otherwise falls back to sidecar files."""
+    if (Path(root) / STATE_DIR / METADATA_DB).exists():
+        return SQLiteStore(root)
+    return SidecarStore()
+
+
+@app.command(name="import")
+def import_sidecars(
+    data_dir: str = typer.Argument(..., help="Dataset directory to consolidate"),
+    remove_sidecars: bool = typer.Option(False, help="Delete the .json sidecars once they're imported"),
+) -> None:
+    """Import a dataset's .json sidecars into a single SQLite metadata database."""
+    from dataset import DatasetDirectory  # pylint: disable=import-outside-toplevel
+
+    dataset = DatasetDirectory(data_dir, store=SidecarStore())
+    sidecars = SidecarStore()
+    items = [
+        (image.path, metadata) for image in tqdm.tqdm(dataset) if (metadata := sidecars.load(image.path)) is not None
+    ]
+
+    store = SQLiteStore(data_dir)
+    store.save_many(items)
+    store.close()
+    typer.echo(f"Imported metadata for {len(items)} images into {store.db_path}")
+
+    if remove_sidecars:
+        for image_path, _ in items:
+            sidecars.delete(image_path)
+
+
+@app.command(name="export")
+def export_sidecars(
+    data_dir: str = typer.Argument(..., help="Dataset directory with a SQLite metadata database"),
+    remove_database: bool = typer.Option(False, help="Delete the database once it's exported"),
+) -> None:
+    """Export a dataset's SQLite metadata database back to .json sidecars."""
+    store = SQLiteStore(data_dir)
+    sidecars = SidecarStore()
+    keys = store.keys()
+    exported = store.load_many(store.root / key for key in keys)
+    for image_path, metadata in tqdm.tqdm(exported.items()):
+        sidecars.save(image_path, metadata)
+    store.close()
+    typer.echo(f"Exported metadata for {len(exported)} images from {store.db_path}")
+
+    if remove_database:
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{store.db_path}{suffix}").unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Local registry of model weights, pinned by SHA-256 checksum so they can be loaded fully offline.
+
+Weights live in $DATA_PREP_MODEL_DIR (default ~/.cache/data-prep/models). Setting DATA_PREP_OFFLINE=1 forbids
+downloads, so a missing or corrupt file fails fast instead of hanging on the network. For air-gapped machines, fetch
+the weights elsewhere and copy them in with the `add` command, which checks them against their pinned checksums.
+
+Models without a checksum in MODELS are pinned to the checksum of their first download from their HTTPS URL (with a
+warning to check it against the published weights), so they work out of the box and can't silently change later.
+Files copied in with `add` are only accepted against a checksum from MODELS or one recorded with the `pin` command.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import typer
+
+from metadata_store import atomic_write
+
+MODEL_DIR = Path(os.environ.get("DATA_PREP_MODEL_DIR", Path.home() / ".cache" / "data-prep" / "models"))
+OFFLINE = os.environ.get("DATA_PREP_OFFLINE", "") not in ("", "0")
+
+CLIP_MODEL = "ViT-L/14"
+MLP_MODEL = "aesthetic-mlp-l14"
+
+
+@dataclass
+class Model:
+    name: str
+    url: str
+    file_name: str
+    # Models without a checksum here are pinned in the lock file on first download, or with `pin`
+    sha256: Optional[str] = None
+
+
+MODELS: Dict[str, Model] = {
+    model.name: model
+    for model in [
+        Model(
+            CLIP_MODEL,
+            "https://openaipublic.azureedge.net/clip/models/"
+            "b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
+            "ViT-L-14.pt",
+            "b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836",
+        ),
+        Model(
+            MLP_MODEL,
+            "https://github.com/christophschuhmann/improved-aesthetic-predictor/raw/main/"
+            "ava%2Blogos-l14-linearMSE.pth",
+            "ava+logos-l14-linearMSE.pth",
+        ),
+    ]
+}
+
+app = typer.Typer()
+
+
+class ModelError(Exception):
+    pass
+
+
+@contextmanager
+def model_errors() -> Iterator[None]:
+    """Reports a ModelError as a CLI error, rather than a traceback."""
+    try:
+        yield
+    except ModelError as e:
+        typer.echo(f"Error: {e}", err=True)
+        raise typer.Exit(1) from e
+
+
+def get_hash(file_path: Path) -> str:
+    """Get the SHA-256 hash of a file."""
+    with open(file_path, "rb") as f:
+        file_hash = hashlib.sha256()
+        while chunk := f.read(1 << 20):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def lock_path() -> Path:
+    return MODEL_DIR / "models.lock.json"
+
+
+def load_lock() -> Dict[str, Dict]:
+    if not lock_path().exists():
+        return {}
+    with open(lock_path(), "r") as f:
+        return json.load(f)
+
+
+def save_lock(lock: Dict[str, Dict]) -> None:
+    MODEL_DIR.mkdir(parents=True, exist_ok=True)
+    with atomic_write(lock_path()) as f:
+        json.dump(lock, f, indent=2)
+
+
+def get_model(name: str) -> Model:
+    if name not in MODELS:
+        raise ModelError(f"Unknown model {name}, expected one of {', '.join(MODELS)}")
+    return MODELS[name]
+
+
+def find_pinned_checksum(model: Model, lock: Dict[str, Dict]) -> Optional[str]:
+    """The checksum a model's weights must have, from MODELS or pinned in the lock file, if there is one yet."""
+    record = lock.get(model.name, {})
+    return model.sha256 or (record.get("sha256") if record.get("pinned") else None)
+
+
+def pinned_checksum(model: Model, lock: Dict[str, Dict]) -> str:
+    """Like `find_pinned_checksum`, but raises if the model isn't pinned."""
+    expected = find_pinned_checksum(model, lock)
+    if not expected:
+        raise ModelError(
+            f"{model.name} has no pinned checksum, so its weights can't be verified. Check the SHA-256 of the "
+            f"published weights ({model.url}) and record it with `model_registry.py pin {model.name} <sha256>`."
+        )
+    return expected
+
+
+def compare_checksum(model: Model, source: str, actual: str, lock: Dict[str, Dict]) -> str:
+    """Raises if the hash of a model's weights (read from `source`) doesn't match its pinned checksum."""
+    expected = pinned_checksum(model, lock)
+    if actual != expected:
+        raise ModelError(f"Checksum mismatch for {model.name} ({source}): expected {expected}, got {actual}")
+    return actual
+
+
+def check(model: Model, file_path: Path, lock: Dict[str, Dict]) -> str:
+    """Hashes a weights file, raising if it doesn't match the model's pinned checksum."""
+    return compare_checksum(model, str(file_path), get_hash(file_path), lock)
+
+
+def verify(model: Model, file_path: Path) -> None:
+    """Checks a registry file against its pinned checksum.
+
+    Verified files are recorded with their size and mtime, so unchanged files aren't rehashed on every load.
+    """
+    lock = load_lock()
+    stat = file_path.stat()
+    record = lock.get(model.name, {})
+    if (
+        record.get("verified") == pinned_checksum(model, lock)
+        and record.get("size") == stat.st_size
+        and record.get("mtime_ns") == stat.st_mtime_ns
+    ):
+        return
+
+    sha256 = check(model, file_path, lock)
+    record.update({"verified": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    lock[model.name] = record
+    save_lock(lock)
+
+
+def download(model: Model, destination: Path) -> None:
+    """Downloads a model's weights, pinning them first if the model has no checksum yet."""
+    if not model.url.startswith("https://"):
+        raise ModelError(f"Refusing to download {model.name} over an insecure connection ({model.url})")
+    MODEL_DIR.mkdir(parents=True, exist_ok=True)
+    typer.echo(f"Downloading {model.name} from {model.url}", err=True)
+    # Hashed while it's written, and only replaces `destination` if the checksum matches
+    with atomic_write(destination, "wb") as f:
+        file_hash = hashlib.sha256()
+        with urllib.request.urlopen(model.url) as response:
+            while chunk := response.read(1 << 20):
+                file_hash.update(chunk)
+                f.write(chunk)
+        sha256 = file_hash.hexdigest()
+        lock = load_lock()
+        if find_pinned_checksum(model, lock) is None:
+            lock[model.name] = {"sha256": sha256, "pinned": True}
+            save_lock(lock)
+            typer.echo(
+                f"Warning: {model.name} has no built in checksum, so it was pinned to that of the download "
+                f"(sha256={sha256}). If that doesn't match the published weights, re-pin it with `pin`.",
+                err=True,
+            )
+        compare_checksum(model, model.url, sha256, lock)
+
+
+def model_path(name: str, offline: bool = OFFLINE) -> Path:
+    """Returns the local path of a model's verified weights, downloading them first unless offline."""
+    model = get_model(name)
+    file_path = MODEL_DIR / model.file_name
+    if not file_path.exists():
+        if offline:
+            raise ModelError(
+                f"{model.name} is not in {MODEL_DIR} and downloads are disabled. "
+                f"Run `model_registry.py fetch` on a connected machine and copy the file over."
+            )
+        download(model, file_path)
+    verify(model, file_path)
+    return file_path
+
+
+@app.command(name="list")
+def list_models() -> None:
+    """List the registered models and whether they're available locally."""
+    lock = load_lock()
+    for model in MODELS.values():
+        file_path = MODEL_DIR / model.file_name
+        status = "present" if file_path.exists() else "missing"
+        checksum = find_pinned_checksum(model, lock) or "unpinned"
+        typer.echo(f"{model.name}: {status} ({file_path}) sha256={checksum}")
+
+
+@app.command()
+def fetch(names: List[str] = typer.Argument(None, help="Models to fetch (default: all)")) -> None:
+    """Download and verify model weights so they can later be loaded offline."""
+    with model_errors():
+        for name in names or list(MODELS):
+            typer.echo(f"{name}: {model_path(name, offline=False)}")
+
+
+@app.command()
+def pin(
+    name: str = typer.Argument(..., help="Name of the model"),
+    sha256: str = typer.Argument(..., help="SHA-256 of the published weights, checked independently"),
+) -> None:
+    """Pin the checksum of a model that doesn't have one built in."""
+    with model_errors():
+        model = get_model(name)
+    if model.sha256:
+        raise typer.BadParameter(f"{name} already has a built in checksum ({model.sha256})")
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise typer.BadParameter(f"{sha256} is not a SHA-256 checksum")
+    lock = load_lock()
+    # Any earlier verification was against a different (or unpinned) checksum
+    lock[name] = {"sha256": sha256, "pinned": True}
+    save_lock(lock)
+    typer.echo(f"Pinned {name} to sha256={sha256}")
+
+
+@app.command()
+def add(
+    name: str = typer.Argument(..., help="Name of the model"),
+    file_path: Path = typer.Argument(..., exists=True, dir_okay=False, help="Weights file to add"),
+) -> None:
+    """Copy an already downloaded weights file into the registry, checking it against its pinned checksum."""
+    with model_errors():
+        model = get_model(name)
+        check(model, file_path, load_lock())
+        MODEL_DIR.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(file_path, MODEL_DIR / model.file_name)
+        typer.echo(f"{name}: {model_path(name, offline=True)}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Exporting a dataset to Parquet files (and importing it back into a directory).
+
+Each row is one image: its path relative to the dataset, tags, aesthetic score, the rest of its metadata (as JSON),
+the order of its metadata's keys and the image file's bytes. Importing writes back exactly the metadata that was
+exported. The image column is stored last, and since Parquet is columnar, reading only the metadata
+columns (`pyarrow.parquet.read_table(path, columns=METADATA_COLUMNS)`, or `datasets.load_dataset("parquet", ...)`
+with `columns=`) never reads the image data.
+
+Files are written from a process pool, each one row group at a time, so memory use is bounded by the row group size
+rather than the size of the dataset.
+"""
+
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tqdm
+import typer
+
+from dataset import DatasetDirectory
+from metadata_store import STATE_DIR, atomic_write, json_default, open_store
+
+app = typer.Typer()
+
+PART_PATTERN = "part-{:06d}.parquet"
+SCHEMA = pa.schema(
+    [
+        ("path", pa.string()),
+        ("tags", pa.list_(pa.string())),
+        ("aesthetic_score", pa.float64()),
+        ("metadata", pa.string()),
+        # Null for images without metadata
+        ("field_order", pa.list_(pa.string())),
+        ("image", pa.binary()),
+    ]
+)
+METADATA_COLUMNS = [name for name in SCHEMA.names if name != "image"]
+
+
+def to_row(root: str, relative_path: str, serialized_metadata: str) -> Dict[str, Any]:
+    metadata: Optional[Dict[str, Any]] = json.loads(serialized_metadata)
+    fields = metadata or {}
+    tags = fields.get("tags")
+    score = fields.get("aesthetic_score")
+    # Values only get moved into their own column if they round trip through it unchanged, otherwise they stay in the
+    # JSON (numeric scores that aren't floats still get a copy in the column, for queries)
+    tags_in_column = isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)
+    score_in_column = isinstance(score, float)
+    inline = {
+        key: value
+        for key, value in fields.items()
+        if not (key == "tags" and tags_in_column) and not (key == "aesthetic_score" and score_in_column)
+    }
+    with open(Path(root) / relative_path, "rb") as f:
+        image = f.read()
+    return {
+        "path": relative_path,
+        "tags": tags if tags_in_column else [],
+        "aesthetic_score": (
+            float(score) if isinstance(score, (int, float)) and not isinstance(score, bool) else None
+        ),
+        "metadata": json.dumps(inline),
+        "field_order": list(fields) if metadata is not None else None,
+        "image": image,
+    }
+
+
+def from_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The metadata exported in a row, with its keys in their original order (None if the image had none)."""
+    if row["field_order"] is None:
+        return None
+    inline = json.loads(row["metadata"])
+    columns = {"tags": row["tags"], "aesthetic_score": row["aesthetic_score"]}
+    return {key: inline[key] if key in inline else columns[key] for key in row["field_order"]}
+
+
+def write_part(
+    root: str, items: List[Tuple[str, str]], path: Path, row_group_size: int, row_group_bytes: int
+) -> Tuple[int, int]:
+    """Writes images (given as relative paths and serialized metadata) to a Parquet file, one row group at a time.
+
+    Returns the number of rows and the file's size."""
+    with atomic_write(path, "wb") as f, pq.ParquetWriter(f, SCHEMA, compression="zstd") as writer:
+        rows: List[Dict[str, Any]] = []
+        buffered_bytes = 0
+        written = 0
+        for relative_path, serialized_metadata in items:
+            try:
+                row = to_row(root, relative_path, serialized_metadata)
+            except OSError as e:
+                print(f"Warning: couldn't read {relative_path}: {e}")
+                continue
+            rows.append(row)
+            written += 1
+            buffered_bytes += len(row["image"])
+            if len(rows) >= row_group_size or buffered_bytes >= row_group_bytes:
+                writer.write_table(pa.Table.from_pylist(rows, SCHEMA), row_group_size=len(rows))
+                rows, buffered_bytes = [], 0
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, SCHEMA), row_group_size=len(rows))
+    return written, path.stat().st_size
+
+
+def chunked(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+@app.command(name="export")
+def export_parquet(
+    data_dir: str = typer.Argument(..., help="Dataset directory to export"),
+    output_dir: str = typer.Argument(..., help="Directory to write Parquet files to"),
+    rows_per_file: int = typer.Option(10000, help="Maximum number of images in each Parquet file"),
+    row_group_size: int = typer.Option(256, help="Maximum number of images in each row group"),
+    row_group_mb: int = typer.Option(256, help="Maximum size of the images in each row group, in MB"),
+    workers: int = typer.Option(os.cpu_count() or 1, help="Number of processes to write files with"),
+) -> None:
+    """Export a dataset's images and metadata to Parquet files."""
+    dataset = DatasetDirectory(data_dir, lazy=True)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    images = 0
+    total_bytes = 0
+    parts = 0
+    with ProcessPoolExecutor(workers) as executor:
+        pending: Set[Future] = set()
+
+        def finish(futures: Iterable[Future]) -> None:
+            nonlocal images, total_bytes
+            for future in futures:
+                pending.discard(future)
+                rows, size = future.result()
+                images += rows
+                total_bytes += size
+
+        # Metadata is read a file's worth at a time, and passed to the workers serialized (keeping its key order)
+        for chunk in tqdm.tqdm(chunked(dataset, rows_per_file), unit="files"):
+            loaded = dataset.store.load_many(image.path for image in chunk)
+            items = [
+                (
+                    Path(os.path.relpath(image.path, data_dir)).as_posix(),
+                    json.dumps(loaded.get(image.path), default=json_default),
+                )
+                for image in chunk
+            ]
+            path = Path(output_dir) / PART_PATTERN.format(parts)
+            pending.add(executor.submit(write_part, data_dir, items, path, row_group_size, row_group_mb * 2**20))
+            parts += 1
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+        finish(list(pending))
+
+    stale = parts
+    while (stale_path := Path(output_dir) / PART_PATTERN.format(stale)).exists():
+        stale_path.unlink()
+        stale += 1
+    typer.echo(f"Exported {images} images into {parts} files ({total_bytes / 2**20:.1f} MB) in {output_dir}")
+
+
+def import_part(path: Path, output_dir: str, overwrite: bool) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    """Writes the images in a Parquet file to `output_dir`, returning their relative paths and metadata."""
+    imported: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=64):
+        for row in batch.to_pylist():
+            relative_path = Path(row["path"])
+            if relative_path.is_absolute() or ".." in relative_path.parts or relative_path.parts[0] == STATE_DIR:
+                print(f"Warning: skipping {row['path']} in {path}, which is outside the dataset")
+                continue
+            image_path = Path(output_dir) / relative_path
+            if overwrite or not image_path.exists():
+                image_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(image_path, "wb") as f:
+                    f.write(row["image"])
+            imported.append((relative_path.as_posix(), from_row(row)))
+    return imported
+
+
+@app.command(name="import")
+def import_parquet(
+    input_dir: str = typer.Argument(..., help="Directory of Parquet files written by `export`"),
+    output_dir: str = typer.Argument(..., help="Dataset directory to write images and metadata to"),
+    overwrite: bool = typer.Option(False, help="Overwrite images that already exist in the output directory"),
+    workers: Optional[int] = typer.Option(None, help="Number of processes to read files with (default: all CPUs)"),
+) -> None:
+    """Rebuild a dataset directory from Parquet files."""
+    parts = sorted(Path(input_dir).glob("part-*.parquet"))
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    # Workers only write images, metadata is saved from here so SQLite stores have a single writer
+    store = open_store(output_dir)
+    images = 0
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(import_part, part, output_dir, overwrite) for part in parts]
+        for future in tqdm.tqdm(futures, unit="files"):
+            imported = future.result()
+            store.save_many(
+                (Path(output_dir) / relative_path, metadata)
+                for relative_path, metadata in imported
+                if metadata is not None
+            )
+            images += len(imported)
+    store.close()
+    typer.echo(f"Imported {images} images from {len(parts)} files into {output_dir}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+CLI that runs several dataset steps in a single pass, instead of running each step's CLI separately.
+
+Steps are listed in a JSON file, in the order they run, either by name or as an object with a "step" name and the
+step's options, e.g.:
+
+    [
+        {"step": "basic_tagging", "filename": true, "subfolders": true},
+        "remove_underscores",
+        "remove_duplicate_tags",
+        {"step": "predict_aesthetic_score", "batch_size": 64},
+        {"step": "remove_low_quality_images", "min_score": 4.5},
+        {"step": "prepare_for_sd_training", "output_dir": "training"}
+    ]
+
+Images are streamed through the steps in chunks: each chunk's metadata is loaded once, passed through every step,
+and saved once at the end, rather than every step walking the dataset and reading and writing every sidecar.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import itertools
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple, Type
+
+import tqdm
+import typer
+
+from basic_tagging import TAGGERS, apply_tags
+from dataset import DatasetDirectory, Image
+from embedding_cache import DEFAULT_CACHE_DIR, open_cache
+from journal import Journal
+from model_registry import CLIP_MODEL, model_errors
+from predict_aesthetic_score import quality_tag
+from convert_images import load_bucket_manifest, save_bucket_manifest
+from prepare_for_sd_training import EXPORT_MODES, copy_image, export_path, image_bucket, passes_score_filter
+from remove_duplicate_tags import remove_subset_tags
+from remove_low_quality_images import is_low_quality
+from remove_underscores import remove_underscores
+
+if TYPE_CHECKING:
+    import torch
+    from clip.clip import Compose
+    from clip.model import CLIP
+
+    from aesthetic_model import MLP, ImageLoader
+
+app = typer.Typer()
+
+
+class Step:
+    """One step of a pipeline. Steps process a chunk of images at a time, returning the images to pass on."""
+
+    name = ""
+
+    def open(self, data_dir: str) -> None:
+        """Called with the dataset directory before any images are processed."""
+
+    def process(self, images: List[Image]) -> List[Image]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Called once every image has been processed."""
+
+
+class BasicTaggingStep(Step):
+    name = "basic_tagging"
+
+    def __init__(self, **options: bool):
+        unknown = set(options) - set(TAGGERS)
+        if unknown:
+            raise TypeError(f"unknown taggers {sorted(unknown)}")
+        self.options = options
+
+    def process(self, images: List[Image]) -> List[Image]:
+        for image in images:
+            apply_tags(image, self.options)
+        return images
+
+
+class RemoveUnderscoresStep(Step):
+    name = "remove_underscores"
+
+    def process(self, images: List[Image]) -> List[Image]:
+        for image in images:
+            remove_underscores(image)
+        return images
+
+
+class RemoveDuplicateTagsStep(Step):
+    name = "remove_duplicate_tags"
+
+    def process(self, images: List[Image]) -> List[Image]:
+        for image in images:
+            remove_subset_tags(image)
+        return images
+
+
+class PredictAestheticScoreStep(Step):
+    """Scores each chunk in batches. The models are loaded when the first chunk needs scoring."""
+
+    name = "predict_aesthetic_score"
+
+    def __init__(
+        self,
+        skip_existing: bool = False,
+        tag_quality: bool = True,
+        batch_size: int = 32,
+        num_workers: int = 4,
+        cache: bool = True,
+        cache_dir: str = str(DEFAULT_CACHE_DIR),
+        device: str = "auto",
+    ):
+        self.skip_existing = skip_existing
+        self.tag_quality = tag_quality
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.cache = open_cache(cache_dir, CLIP_MODEL) if cache else None
+        self.device_name = device
+        self.models: Optional[tuple[CLIP, MLP, Compose, torch.device]] = None
+        # Kept for the whole run, so its worker processes aren't restarted for every chunk
+        self.loader: Optional[ImageLoader] = None
+
+    def load_models(self) -> tuple[CLIP, MLP, Compose, torch.device]:
+        # pylint: disable=import-outside-toplevel
+        import torch
+
+        from aesthetic_model import load_clip, load_mlp
+
+        if self.device_name == "auto":
+            self.device_name = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(self.device_name)
+        with model_errors():
+            clip_model, preprocess = load_clip(device)
+            return clip_model, load_mlp(device), preprocess, device
+
+    def process(self, images: List[Image]) -> List[Image]:
+        to_score = [image for image in images if not (self.skip_existing and "aesthetic_score" in image.metadata)]
+        if not to_score:
+            return images
+
+        # pylint: disable=import-outside-toplevel
+        from aesthetic_model import ImageLoader, get_aesthetic_scores
+
+        if self.models is None:
+            self.models = self.load_models()
+        clip_model, mlp, preprocess, device = self.models
+        if self.loader is None:
+            self.loader = ImageLoader(preprocess, device, self.batch_size, self.num_workers)
+
+        scores = get_aesthetic_scores(
+            to_score, clip_model, mlp, preprocess, device, self.batch_size, self.num_workers, self.cache, self.loader
+        )
+        for image, score in scores:
+            if score is None:
+                typer.echo(f"{image.path}: could not be loaded")
+                continue
+            image.metadata["aesthetic_score"] = score
+            if self.tag_quality and (tag := quality_tag(score)):
+                image.add_tag(tag)
+        return images
+
+    def close(self) -> None:
+        if self.loader is not None:
+            self.loader.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+class RemoveLowQualityImagesStep(Step):
+    """Deletes images scoring below `min_score`. Unlike the standalone CLI this doesn't ask for confirmation."""
+
+    name = "remove_low_quality_images"
+
+    def __init__(self, min_score: float, remove_invalid: bool = False):
+        self.min_score = min_score
+        self.remove_invalid = remove_invalid
+        self.removed = 0
+
+    def process(self, images: List[Image]) -> List[Image]:
+        kept = []
+        for image in images:
+            if is_low_quality(image, self.min_score, self.remove_invalid):
+                image.delete()
+                self.removed += 1
+            else:
+                kept.append(image)
+        return kept
+
+    def close(self) -> None:
+        typer.echo(f"{self.name}: deleted {self.removed} images")
+
+
+class PrepareForSDTrainingStep(Step):
+    name = "prepare_for_sd_training"
+
+    def __init__(self, output_dir: str, aesthetic_score: float = 0.0, force: bool = False, mode: str = "copy"):
+        if mode not in EXPORT_MODES:
+            raise TypeError(f"mode must be one of {', '.join(EXPORT_MODES)}")
+        self.output_dir = output_dir
+        self.aesthetic_score = aesthetic_score
+        self.force = force
+        self.mode = mode
+        self.journal: Optional[Journal] = None
+        self.data_dir = ""
+        self.buckets: Dict[str, Tuple[int, int]] = {}
+        self.exported_buckets: Dict[str, Tuple[int, int]] = {}
+        self.copied = 0
+        self.skipped = 0
+
+    def open(self, data_dir: str) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.journal = Journal(data_dir, state_root=self.output_dir)
+        self.data_dir = data_dir
+        self.buckets = load_bucket_manifest(data_dir)
+
+    def process(self, images: List[Image]) -> List[Image]:
+        assert self.journal is not None
+        for image in images:
+            if not passes_score_filter(image, self.aesthetic_score):
+                continue
+            if (bucket := image_bucket(image, self.data_dir, self.buckets)) is not None:
+                self.exported_buckets[str(export_path(image, self.output_dir))] = bucket
+            if copy_image(image, self.output_dir, self.journal, self.force, self.mode):
+                self.copied += 1
+            else:
+                self.skipped += 1
+        return images
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.save()
+        if self.buckets:
+            save_bucket_manifest(self.output_dir, self.exported_buckets)
+        typer.echo(f"{self.name}: copied {self.copied} images, {self.skipped} were already up to date")
+
+
+STEPS: Dict[str, Type[Step]] = {
+    step.name: step
+    for step in (
+        BasicTaggingStep,
+        RemoveUnderscoresStep,
+        RemoveDuplicateTagsStep,
+        PredictAestheticScoreStep,
+        RemoveLowQualityImagesStep,
+        PrepareForSDTrainingStep,
+    )
+}
+
+
+def load_steps(steps_file: str) -> List[Step]:
+    """Creates the steps listed in a JSON steps file."""
+    with open(steps_file, "r") as f:
+        specs: List[Any] = json.load(f)
+
+    steps = []
+    for spec in specs:
+        options: Dict[str, Any] = {"step": spec} if isinstance(spec, str) else dict(spec)
+        name = options.pop("step", None)
+        if name not in STEPS:
+            raise typer.BadParameter(f"Unknown step {name!r}, expected one of {', '.join(STEPS)}")
+        try:
+            steps.append(STEPS[name](**options))
+        except TypeError as e:
+            raise typer.BadParameter(f"Invalid options for step {name!r}: {e}") from e
+    return steps
+
+
+@app.command()
+def run(
+    steps_file: str = typer.Argument(..., help="JSON file listing the steps to run, in order"),
+    data_dir: str = typer.Argument(..., help="Dataset directory to process"),
+    chunk_size: int = typer.Option(256, help="Number of images loaded, processed and saved at a time"),
+) -> None:
+    """Run a list of steps over a dataset in a single pass, loading and saving each image's metadata once."""
+    steps = load_steps(steps_file)
+    dataset = DatasetDirectory(data_dir, lazy=True)
+    timings: Dict[str, float] = {name: 0.0 for name in ("scan", "load", *(step.name for step in steps), "save")}
+
+    @contextlib.contextmanager
+    def timed(name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        yield
+        timings[name] += time.perf_counter() - start
+
+    for step in steps:
+        step.open(data_dir)
+
+    images = iter(dataset)
+    processed = 0
+    with tqdm.tqdm(unit="images") as progress:
+        while True:
+            with timed("scan"):
+                chunk = list(itertools.islice(images, chunk_size))
+            if not chunk:
+                break
+            with timed("load"):
+                dataset.load_metadata(chunk)
+            remaining = chunk
+            for step in steps:
+                with timed(step.name):
+                    remaining = step.process(remaining) if remaining else remaining
+            with timed("save"):
+                dataset.save_metadata(remaining)
+            processed += len(chunk)
+            progress.update(len(chunk))
+
+    for step in steps:
+        with timed(step.name):
+            step.close()
+    with timed("save"):
+        dataset.flush()
+
+    typer.echo(f"Processed {processed} images")
+    total = sum(timings.values())
+    for name, seconds in timings.items():
+        typer.echo(f"{name:>28}: {seconds:8.2f}s ({seconds / total * 100 if total else 0.0:5.1f}%)")
+
+
+if __name__ == "__main__":
+    app()
@@ -5,100 +5,72 @@ CLI utility that uses a CLIP-based model to predict aesthetic scores for an imag
 Based on https://github.com/christophschuhmann/improved-aesthetic-predictor
 """
 
+from __future__ import annotations
+
+import contextlib
+import random
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
-import clip
-import pytorch_lightning as pl
-import torch
-import torch.nn as nn
-import torch.utils.model_zoo
 import tqdm
 import typer
-from clip.clip import Compose
-from clip.model import CLIP
-from PIL import Image as PILImage
-from PIL import UnidentifiedImageError
 
 from dataset import DatasetDirectory, Image
-
-
-class MLP(pl.LightningModule):
-    def __init__(self, input_size, xcol="emb", ycol="avg_rating"):
-        super().__init__()
-        self.input_size = input_size
-        self.xcol = xcol
-        self.ycol = ycol
-        self.layers = nn.Sequential(
-            nn.Linear(self.input_size, 1024),
-            # nn.ReLU(),
-            nn.Dropout(0.2),
-            nn.Linear(1024, 128),
-            # nn.ReLU(),
-            nn.Dropout(0.2),
-            nn.Linear(128, 64),
-            # nn.ReLU(),
-            nn.Dropout(0.1),
-            nn.Linear(64, 16),
-            # nn.ReLU(),
-            nn.Linear(16, 1),
-        )
-
-    def forward(self, x):
-        return self.layers(x)
-
-    def training_step(self, batch, batch_idx):
-        x = batch[self.xcol]
-        y = batch[self.ycol].reshape(-1, 1)
-        x_hat = self.layers(x)
-        loss = nn.functional.mse_loss(x_hat, y)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        x = batch[self.xcol]
-        y = batch[self.ycol].reshape(-1, 1)
-        x_hat = self.layers(x)
-        loss = nn.functional.mse_loss(x_hat, y)
-        return loss
-
-    def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
-        return optimizer
-
-
-def normalized(a, axis=-1, order=2):
-    import numpy as np  # pylint: disable=import-outside-toplevel
-
-    l2 = np.atleast_1d(np.linalg.norm(a, order, axis))
-    l2[l2 == 0] = 1
-    return a / np.expand_dims(l2, axis)
-
-
-def load_clip(device: torch.device) -> tuple[CLIP, Compose]:
-    return clip.load("ViT-L/14", device=device)
-
-
-def load_mlp(device: torch.device) -> MLP:
-    state_dict = torch.utils.model_zoo.load_url(
-        "https://github.com/christophschuhmann/improved-aesthetic-predictor/raw/main/ava%2Blogos-l14-linearMSE.pth"
+from embedding_cache import DEFAULT_CACHE_DIR, open_cache
+from model_registry import CLIP_MODEL, model_errors
+
+if TYPE_CHECKING:
+    from clip.clip import Compose
+    from clip.model import CLIP
+
+    from aesthetic_model import MLP, CPUImageEncoder
+
+
+def quality_tag(score: float) -> Optional[str]:
+    """The quality tag for an aesthetic score, if any."""
+    if score > 6.5:
+        return "masterpiece"
+    if score > 6:
+        return "high quality"
+    if score < 4.5:
+        return "low quality"
+    return None
+
+
+def report_drift(
+    images: List[Image],
+    reference: Tuple[CLIP, MLP],
+    candidate: Tuple[CPUImageEncoder, MLP],
+    preprocess: Compose,
+    sample_size: int,
+    batch_size: int,
+) -> None:
+    """Scores a random sample of images with both the fp32 reference and the reduced precision models,
+    and reports how far the scores (and resulting quality tags) drift."""
+    import torch  # pylint: disable=import-outside-toplevel
+
+    from aesthetic_model import get_aesthetic_scores  # pylint: disable=import-outside-toplevel
+
+    sample = random.Random(0).sample(images, min(sample_size, len(images)))
+    device = torch.device("cpu")
+
+    reference_scores = dict(get_aesthetic_scores(sample, *reference, preprocess, device, batch_size, 0))
+    candidate_scores = dict(get_aesthetic_scores(sample, *candidate, preprocess, device, batch_size, 0))
+    pairs = [
+        (reference_scores[image], candidate_scores[image])
+        for image in sample
+        if reference_scores.get(image) is not None and candidate_scores.get(image) is not None
+    ]
+    if not pairs:
+        typer.echo("No readable images to measure drift on")
+        return
+
+    drifts = sorted(abs(reference - candidate) for reference, candidate in pairs)
+    tag_changes = sum(quality_tag(reference) != quality_tag(candidate) for reference, candidate in pairs)
+    typer.echo(
+        f"Score drift from fp32 over {len(pairs)} images: mean {sum(drifts) / len(drifts):.4f}, "
+        f"p95 {drifts[int(0.95 * (len(drifts) - 1))]:.4f}, max {drifts[-1]:.4f}, "
+        f"quality tag changes {tag_changes} ({tag_changes / len(pairs) * 100:.2f}%)"
     )
-    mlp = MLP(768)
-    mlp.load_state_dict(state_dict)
-    mlp.eval()
-    mlp.to(device)
-
-    return mlp
-
-
-def get_aesthetic_score(image: Image, clip: CLIP, mlp: MLP, preprocess: Compose, device: torch.device) -> float:
-    pil_image = PILImage.open(image.path).convert("RGB")
-    preprocessed_image = preprocess(pil_image).unsqueeze(0).to(device)
-
-    with torch.no_grad():
-        image_features = clip.encode_image(preprocessed_image)
-
-    processed_features = normalized(image_features.cpu().detach().numpy())
-    prediction = mlp(torch.from_numpy(processed_features).to(device).type(torch.cuda.FloatTensor))
-
-    return prediction.item()
 
 
 app = typer.Typer()
@@ -109,37 +81,79 @@ def predict_aesthetic_scores(
     data_dir: str = typer.Argument(..., help="Path to the data directory"),
     skip_existing: bool = typer.Option(False, help="Skip images that already have an aesthetic score"),
     tag_quality: bool = typer.Option(True, help="Tag images with a quality score"),
+    batch_size: int = typer.Option(32, help="Number of images to run through CLIP at once"),
+    num_workers: int = typer.Option(4, help="Number of worker processes used to decode and preprocess images"),
+    cache: bool = typer.Option(True, help="Store CLIP embeddings on disk and reuse them for unchanged images"),
+    cache_dir: str = typer.Option(str(DEFAULT_CACHE_DIR), help="Directory to store cached embeddings in"),
+    max_cache_entries: int = typer.Option(0, help="Maximum number of cached embeddings (0 for no limit)"),
+    device_name: str = typer.Option("auto", "--device", help="Device to run on: auto, cpu or cuda"),
+    threads: int = typer.Option(0, help="Number of intra-op threads to use on CPU (0 for PyTorch's default)"),
+    quantize: bool = typer.Option(False, help="Dynamically quantize CLIP's visual tower and MLP to int8 (CPU only)"),
+    bf16: bool = typer.Option(False, help="Run CLIP's visual tower under bfloat16 autocast (CPU only)"),
+    drift_sample: int = typer.Option(
+        0, help="Before scoring, report how far quantized/bf16 scores drift from fp32 on this many images"
+    ),
 ) -> None:
     """
     Predict aesthetic scores for images in a directory.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # pylint: disable=import-outside-toplevel
+    import torch
+
+    from aesthetic_model import CPUImageEncoder, get_aesthetic_scores, load_clip, load_mlp, quantize_mlp
+
+    if device_name == "auto":
+        device_name = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device_name)
+    if (quantize or bf16) and device.type != "cpu":
+        raise typer.BadParameter("--quantize and --bf16 are only supported with --device cpu")
+    if quantize and bf16:
+        raise typer.BadParameter("--quantize and --bf16 can't be combined")
+    if threads > 0:
+        torch.set_num_threads(threads)
 
     dataset = DatasetDirectory(data_dir)
-    clip_model, preprocess = load_clip(device)
-    mlp = load_mlp(device)
+    dataset.load_metadata()
+    with model_errors():
+        clip_model, preprocess = load_clip(device)
+        mlp = load_mlp(device)
 
-    for image in tqdm.tqdm(dataset):
+    images: list[Image] = []
+    for image in dataset:
         if skip_existing and "aesthetic_score" in image.metadata:
             typer.echo(f"{image.path}: already has aesthetic score, skipping")
             continue
-        try:
-            score = get_aesthetic_score(image, clip_model, mlp, preprocess, device)
-        except UnidentifiedImageError:
-            typer.echo(f"{image.path}: UnidentifiedImageError")
-            continue
-        typer.echo(f"{image.path}: {score}")
-        image.metadata["aesthetic_score"] = score
-
-        if tag_quality:
-            if score > 6.5:
-                image.add_tag("masterpiece")
-            elif score > 6:
-                image.add_tag("high quality")
-            elif score < 4.5:
-                image.add_tag("low quality")
-
-        image.save_metadata()
+        images.append(image)
+
+    model_name = CLIP_MODEL
+    encoder: CLIP | CPUImageEncoder = clip_model
+    if quantize or bf16:
+        # Keep the fp32 models around only if they're needed as a reference
+        encoder = CPUImageEncoder(clip_model, quantize, bf16, inplace=drift_sample == 0)
+        reduced_mlp = quantize_mlp(mlp) if quantize else mlp
+        if drift_sample > 0:
+            report_drift(images, (clip_model, mlp), (encoder, reduced_mlp), preprocess, drift_sample, batch_size)
+        mlp = reduced_mlp
+        # Reduced precision embeddings differ slightly, so they mustn't mix with fp32 ones in the cache
+        model_name = f"{CLIP_MODEL}-{'int8' if quantize else 'bf16'}"
+
+    embedding_cache = open_cache(cache_dir, model_name, max_cache_entries) if cache else None
+    with embedding_cache if embedding_cache is not None else contextlib.nullcontext():
+        scores = get_aesthetic_scores(
+            images, encoder, mlp, preprocess, device, batch_size, num_workers, embedding_cache
+        )
+        for image, score in tqdm.tqdm(scores, total=len(images)):
+            if score is None:
+                typer.echo(f"{image.path}: could not be loaded")
+                continue
+            typer.echo(f"{image.path}: {score}")
+            image.metadata["aesthetic_score"] = score
+
+            if tag_quality and (tag := quality_tag(score)):
+                image.add_tag(tag)
+
+            image.save_metadata()
+        dataset.flush()
 
 
 if __name__ == "__main__":
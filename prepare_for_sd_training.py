@@ -2,48 +2,258 @@
 
 Given a directory, it recursively searches for images in that directory and copies them into an output directory.
 It also converts the "tags" field of the metadata to a .txt file with the same name (comma-separated).
+
+Rather than copying, images can be hardlinked, symlinked or reflinked (a copy-on-write clone, on filesystems that
+support it) with --mode. Copies use copy_file_range, which lets the kernel (or a network filesystem's server) copy
+without passing the bytes through this process. Images are exported from a thread pool, and images exported before
+that haven't changed since are skipped.
+
+With --tar, images are instead packed into WebDataset-style tar shards (see tar_shards.py).
+
+If the images were resized to aspect ratio buckets (convert_images.py --bucket-resolution), their buckets.json
+manifest is rewritten for the exported file names, or with --tar each sample's bucket is stored in its .json.
 """
 
+import errno
 import os
 import shutil
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import tqdm
 import typer
 
-from dataset import DatasetDirectory
+from convert_images import BUCKET_MANIFEST, load_bucket_manifest, save_bucket_manifest
+from dataset import DatasetDirectory, Image
+from journal import Journal
+from query import select
+from tar_shards import Sample, write_shards
 
 app = typer.Typer()
 
+PREPARE_VERSION = 1
+EXPORT_MODES = ("copy", "hardlink", "symlink", "reflink")
+# ioctl cloning one file's extents into another (Linux, on btrfs, XFS and others)
+FICLONE = 0x40049409
+# Errors meaning a zero-copy method isn't supported for these files, so the next best method should be used instead
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM}
+
+
+def passes_score_filter(image: Image, aesthetic_score: float) -> bool:
+    """Whether an image's aesthetic score is at least `aesthetic_score` (always true if that's 0)."""
+    if aesthetic_score > 0 and (found_score := image.metadata.get("aesthetic_score", 0.0)) < aesthetic_score:
+        if found_score == 0.0:
+            typer.echo(f"Warning: no aesthetic score for {image.path}")
+        return False
+    return True
+
+
+def copy_file(source: Path, destination: Path) -> None:
+    """Copies a file with copy_file_range, falling back to a regular copy where that isn't supported."""
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            remaining = os.fstat(source_file.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        return
+    except AttributeError:
+        pass  # No copy_file_range on this platform
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+    shutil.copyfile(source, destination)
+
+
+def reflink_file(source: Path, destination: Path) -> None:
+    """Clones a file (sharing its data until either copy is changed), falling back to copying it."""
+    import fcntl  # pylint: disable=import-outside-toplevel
+
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+    copy_file(source, destination)
+
+
+def export_file(source: Path, destination: Path, mode: str) -> None:
+    """Exports a file with the given mode, replacing `destination` atomically if it already exists."""
+    temp_path = destination.with_name(f".{destination.name}.tmp")
+    temp_path.unlink(missing_ok=True)
+    if mode == "hardlink":
+        try:
+            os.link(source, temp_path)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            copy_file(source, temp_path)  # Across filesystems
+    elif mode == "symlink":
+        os.symlink(source.resolve(), temp_path)
+    elif mode == "reflink":
+        reflink_file(source, temp_path)
+    else:
+        copy_file(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+def export_image(source: Path, output_path: Path, caption: str, mode: str = "copy") -> None:
+    """Exports an image to `output_path`, along with a .txt file of its caption."""
+    with open(output_path.with_suffix(".txt"), "w") as f:
+        f.write(caption)
+    export_file(source, output_path, mode)
+
+
+def journal_options(mode: str) -> Dict[str, str]:
+    # Copies are journaled without options, as they were before there were other modes, so they aren't redone
+    return {} if mode == "copy" else {"mode": mode}
+
+
+def export_path(image: Image, output_dir: str) -> Path:
+    # Exports are flattened into the output directory
+    return Path(output_dir) / image.path.name
+
+
+def image_bucket(image: Image, input_dir: str, buckets: Dict[str, Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    """The bucket an image is in, according to the input directory's bucket manifest."""
+    return buckets.get(Path(os.path.relpath(image.path, input_dir)).as_posix())
+
+
+def pending_export(
+    image: Image, output_dir: str, journal: Journal, force: bool = False, mode: str = "copy"
+) -> Optional[Tuple[Path, str]]:
+    """The output path and caption to export an image with, or None if it was already exported with the same mode
+    and neither the image nor its tags changed since."""
+    output_path = export_path(image, output_dir)
+    caption = ", ".join(image.tags)
+    already_copied = output_path.exists() and journal.is_done(
+        image.path, "prepare_for_sd_training", PREPARE_VERSION, journal_options(mode), caption
+    )
+    if already_copied and not force:
+        return None
+    return output_path, caption
+
+
+def copy_image(image: Image, output_dir: str, journal: Journal, force: bool = False, mode: str = "copy") -> bool:
+    """Copies (or links) an image and a .txt caption of its tags to the output directory.
+
+    Returns False (without copying) if it was already copied and neither the image nor its tags changed since.
+    """
+    pending = pending_export(image, output_dir, journal, force, mode)
+    if pending is None:
+        return False
+    output_path, caption = pending
+    export_image(image.path, output_path, caption, mode)
+    journal.record(image.path, "prepare_for_sd_training", PREPARE_VERSION, journal_options(mode), caption)
+    return True
+
 
 @app.command()
 def prepare_dataset(
     input_dir: str = typer.Argument(..., help="Directory containing images to process"),
     output_dir: str = typer.Argument(..., help="Directory to save processed images"),
     aesthetic_score: float = typer.Option(0.0, help="Aesthetic score to filter images by"),
+    force: bool = typer.Option(False, help="Copy images even if they were already copied and haven't changed"),
+    where: Optional[str] = typer.Option(
+        None, help="Only copy images matching this expression (see query.py), e.g. \"'techwear' in tags\""
+    ),
+    mode: str = typer.Option("copy", help=f"How to export images: {', '.join(EXPORT_MODES)}"),
+    workers: int = typer.Option(8, help="Number of threads to export images (or write shards) with"),
+    tar: bool = typer.Option(False, help="Pack images, captions and metadata into tar shards instead"),
+    shard_size_mb: int = typer.Option(1024, help="Maximum size of each tar shard, in MB"),
+    samples_per_shard: int = typer.Option(10000, help="Maximum number of samples in each tar shard"),
+    shuffle: bool = typer.Option(False, help="Shuffle samples across tar shards"),
+    seed: int = typer.Option(0, help="Seed for --shuffle"),
+    metadata_fields: List[str] = typer.Option(
+        ["aesthetic_score"], "--metadata-field", help="Metadata fields to include in tar shards (repeatable)"
+    ),
 ):
+    if mode not in EXPORT_MODES:
+        raise typer.BadParameter(f"--mode must be one of {', '.join(EXPORT_MODES)}")
     dataset = DatasetDirectory(input_dir)
+    buckets = load_bucket_manifest(input_dir)
+    images: Iterable[Image] = dataset
+    if where is not None:
+        # Selected from the dataset's indexes, so images that don't match are never loaded
+        images = list(select(dataset, where))
+        dataset.load_metadata(images)
+    else:
+        dataset.load_metadata()
+
+    if tar:
+        samples = [
+            Sample(
+                f"{i:08d}",
+                image.path,
+                ", ".join(image.tags),
+                {
+                    "path": Path(os.path.relpath(image.path, input_dir)).as_posix(),
+                    **{field: image.metadata[field] for field in metadata_fields if field in image.metadata},
+                    **({"bucket": list(bucket)} if (bucket := image_bucket(image, input_dir, buckets)) else {}),
+                },
+            )
+            for i, image in enumerate(image for image in images if passes_score_filter(image, aesthetic_score))
+        ]
+        shards = write_shards(
+            samples, output_dir, shard_size_mb * 1024 * 1024, samples_per_shard, workers, shuffle, seed
+        )
+        typer.echo(f"Packed {len(samples)} out of {len(dataset)} images into {len(shards)} shards in {output_dir}")
+        return
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    journal = Journal(input_dir, state_root=output_dir)
 
     copied_count = 0
-    for image in tqdm.tqdm(dataset):
-        if aesthetic_score > 0 and (found_score := image.metadata.get("aesthetic_score", 0.0)) < aesthetic_score:
-            if found_score == 0.0:
-                typer.echo(f"Warning: no aesthetic score for {image.path}")
-            continue
-
-        output_path: Path = Path(output_dir) / image.path.name
-        with open(output_path.with_suffix(".txt"), "w") as f:
-            f.write(", ".join(image.tags))
-        shutil.copy(image.path, output_path)
-        copied_count += 1
+    skipped_count = 0
+    # Buckets of the images in the output directory, by their exported path
+    exported_buckets: Dict[str, Tuple[int, int]] = {}
+    # The journal isn't thread safe, so only the exports themselves run in the pool
+    with ThreadPoolExecutor(workers) as executor:
+        pending: Dict[Future, Tuple[Image, str]] = {}
+
+        def finish(futures: Iterable[Future]) -> None:
+            nonlocal copied_count
+            for future in futures:
+                image, caption = pending.pop(future)
+                if (error := future.exception()) is not None:
+                    typer.echo(f"Error exporting {image.path}: {error}")
+                    exported_buckets.pop(str(export_path(image, output_dir)), None)
+                    continue
+                journal.record(image.path, "prepare_for_sd_training", PREPARE_VERSION, journal_options(mode), caption)
+                copied_count += 1
+
+        for image in tqdm.tqdm(images):
+            if not passes_score_filter(image, aesthetic_score):
+                continue
+            if (bucket := image_bucket(image, input_dir, buckets)) is not None:
+                exported_buckets[str(export_path(image, output_dir))] = bucket
+            export = pending_export(image, output_dir, journal, force, mode)
+            if export is None:
+                skipped_count += 1
+                continue
+            output_path, caption = export
+            pending[executor.submit(export_image, image.path, output_path, caption, mode)] = (image, caption)
+            if len(pending) >= workers * 4:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+        finish(list(pending))
 
+    journal.save()
+    if buckets:
+        save_bucket_manifest(output_dir, exported_buckets)
+        typer.echo(f"Wrote {BUCKET_MANIFEST} for {len(exported_buckets)} exported images")
     dataset_size = len(dataset)
     typer.echo(
         f"Copied {copied_count} out of {dataset_size} ({copied_count / dataset_size * 100:.2f}%) to {output_dir}"
     )
+    if skipped_count:
+        typer.echo(f"Skipped {skipped_count} images that were already copied and haven't changed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Selecting images from a dataset by a predicate on their metadata, without loading the metadata of every image.
+
+Predicates are Python-like expressions, e.g.
+
+    aesthetic_score >= 5.5 and 'techwear' in tags and not 'reg' in subfolders
+    4 < aesthetic_score < 6 or source == 'vogue'
+    aesthetic_score == None
+
+Numeric fields are answered from sorted column indexes (a binary search per range), fields like `source` from
+categorical columns, tags from the dataset's tag index and subfolders from image paths. The indexes live in the
+dataset's state directory and, like the tag index, are brought up to date by rereading only images whose metadata
+changed. Also a CLI for listing or counting matching images.
+"""
+
+from __future__ import annotations
+
+import ast
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import typer
+
+from dataset import DatasetDirectory, Image
+from metadata_store import STATE_DIR, atomic_write, state_path
+from tag_index import TagIndex, find_changed_images
+
+METADATA_INDEX = "metadata_index.npz"
+METADATA_INDEX_VERSION = 1
+# String fields indexed for equality comparisons (other strings, like titles, are too unique to be worth it)
+CATEGORICAL_FIELDS = ("source", "category", "subreddit")
+
+app = typer.Typer()
+
+
+class MetadataIndex:
+    """Column indexes of a dataset's numeric and categorical metadata fields, keyed by image path relative to `root`.
+
+    Every top-level numeric field is indexed. Each column holds one value per image id (NaN if the image doesn't
+    have the field), along with the ids sorted by value, so range queries are a binary search.
+    """
+
+    def __init__(self, root: Union[Path, str]):
+        self.root = Path(root)
+        self.paths: List[Optional[str]] = []
+        self.ids: Dict[str, int] = {}
+        self.signatures: List[Optional[List[int]]] = []
+        self.numeric: Dict[str, np.ndarray] = {}
+        self.categories: Dict[str, List[str]] = {field: [] for field in CATEGORICAL_FIELDS}
+        self.codes: Dict[str, np.ndarray] = {field: np.zeros(0, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        self._order: Dict[str, np.ndarray] = {}
+        self._category_codes: Dict[str, Dict[str, int]] = {}
+
+    @classmethod
+    def load(cls, root: Union[Path, str]) -> MetadataIndex:
+        """Loads a dataset's metadata index, or returns an empty one if it doesn't have one."""
+        index = cls(root)
+        try:
+            with np.load(Path(root) / STATE_DIR / METADATA_INDEX) as data:
+                header = json.loads(data["header"].tobytes())
+                if header.get("version") != METADATA_INDEX_VERSION:
+                    return index
+                for i, field in enumerate(header["numeric"]):
+                    index.numeric[field] = data[f"numeric_{i}"]
+                    index._order[field] = data[f"order_{i}"]
+                for i, field in enumerate(CATEGORICAL_FIELDS):
+                    index.codes[field] = data[f"codes_{i}"]
+        except (OSError, ValueError, KeyError):
+            return cls(root)
+
+        index.paths = header["paths"]
+        index.signatures = header["signatures"]
+        index.categories = header["categories"]
+        index.ids = {path: image_id for image_id, path in enumerate(index.paths) if path is not None}
+        return index
+
+    def save(self) -> None:
+        fields = list(self.numeric)
+        header = {
+            "version": METADATA_INDEX_VERSION,
+            "paths": self.paths,
+            "signatures": self.signatures,
+            "numeric": fields,
+            "categories": self.categories,
+        }
+        arrays = {"header": np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)}
+        for i, field in enumerate(fields):
+            arrays[f"numeric_{i}"] = self.numeric[field]
+            arrays[f"order_{i}"] = self.order(field)
+        for i, field in enumerate(CATEGORICAL_FIELDS):
+            arrays[f"codes_{i}"] = self.codes[field]
+
+        with atomic_write(state_path(self.root, METADATA_INDEX), "wb") as f:
+            np.savez(f, **arrays)
+
+    def key(self, image_path: Union[Path, str]) -> str:
+        return Path(os.path.relpath(image_path, self.root)).as_posix()
+
+    def _grow(self, size: int) -> None:
+        for field, values in self.numeric.items():
+            if len(values) < size:
+                self.numeric[field] = np.concatenate([values, np.full(size - len(values), np.nan)])
+        for field, codes in self.codes.items():
+            if len(codes) < size:
+                self.codes[field] = np.concatenate([codes, np.full(size - len(codes), -1, dtype=np.int32)])
+
+    def _image_id(self, key: str) -> int:
+        image_id = self.ids.get(key)
+        if image_id is None:
+            image_id = self.ids[key] = len(self.paths)
+            self.paths.append(key)
+            self.signatures.append(None)
+        return image_id
+
+    def _clear(self, image_id: int) -> None:
+        for values in self.numeric.values():
+            values[image_id] = np.nan
+        for codes in self.codes.values():
+            codes[image_id] = -1
+
+    def reindex(self, entries: List[Tuple[str, Dict[str, Any], Optional[List[int]]]]) -> None:
+        """Replaces the indexed fields of many images at once, given each image's key, metadata and signature."""
+        image_ids = [self._image_id(key) for key, _, _ in entries]
+        self._grow(len(self.paths))
+        for image_id, (_, metadata, signature) in zip(image_ids, entries):
+            self.signatures[image_id] = signature
+            self._clear(image_id)
+            for field, value in metadata.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if field not in self.numeric:
+                        self.numeric[field] = np.full(len(self.paths), np.nan)
+                    self.numeric[field][image_id] = value
+                elif field in self.codes and isinstance(value, str):
+                    self.codes[field][image_id] = self.category_code(field, value, add=True)
+        if entries:
+            self._order.clear()
+
+    def remove_image(self, key: str) -> None:
+        image_id = self.ids.pop(key, None)
+        if image_id is not None:
+            self.paths[image_id] = None
+            self.signatures[image_id] = None
+            self._clear(image_id)
+            self._order.clear()
+
+    def refresh(self, dataset: DatasetDirectory, full: bool = False) -> Dict[str, Image]:
+        """Brings the index up to date with a dataset, rereading only images whose metadata changed.
+
+        Returns the dataset's images by key, so matches can be returned as the dataset's own `Image`s.
+        """
+        changed, seen = find_changed_images(dataset, self.key, self.ids, self.signatures, full)
+        removed = [key for key in self.ids if key not in seen]
+        for key in removed:
+            self.remove_image(key)
+        dataset.load_metadata([image for image, _ in changed])
+        self.reindex([(self.key(image.path), image.metadata, signature) for image, signature in changed])
+        if changed or removed:
+            self.save()
+        return {self.key(image.path): image for image in dataset}
+
+    def order(self, field: str) -> np.ndarray:
+        """Ids of the images with a value for `field`, sorted by it."""
+        if field not in self._order:
+            values = self.numeric[field]
+            order = np.argsort(values, kind="stable")
+            self._order[field] = order[: np.count_nonzero(~np.isnan(values))].astype(np.uint32)
+        return self._order[field]
+
+    def live_ids(self) -> np.ndarray:
+        return np.fromiter(sorted(self.ids.values()), dtype=np.uint32, count=len(self.ids))
+
+    def range(self, field: str, operator: str, value: float) -> np.ndarray:
+        """Sorted ids of the images whose `field` compares to `value` with `operator` (<, <=, >, >=, ==, !=)."""
+        if field not in self.numeric:
+            return np.zeros(0, dtype=np.uint32)
+        order = self.order(field)
+        sorted_values = self.numeric[field][order]
+        left = int(np.searchsorted(sorted_values, value, side="left"))
+        right = int(np.searchsorted(sorted_values, value, side="right"))
+        selected = {
+            "<": order[:left],
+            "<=": order[:right],
+            ">": order[right:],
+            ">=": order[left:],
+            "==": order[left:right],
+            "!=": np.concatenate([order[:left], order[right:]]),
+        }[operator]
+        return np.sort(selected)
+
+    def missing(self, field: str) -> np.ndarray:
+        """Sorted ids of the images that don't have `field`."""
+        live = self.live_ids()
+        if field in self.numeric:
+            return live[np.isnan(self.numeric[field][live])]
+        if field in self.codes:
+            return live[self.codes[field][live] < 0]
+        return live
+
+    def category_code(self, field: str, value: str, add: bool = False) -> int:
+        """The code a categorical field's value is stored as (-1 if no image has it, unless `add`)."""
+        if field not in self._category_codes:
+            self._category_codes[field] = {category: code for code, category in enumerate(self.categories[field])}
+        codes = self._category_codes[field]
+        if value not in codes and add:
+            codes[value] = len(self.categories[field])
+            self.categories[field].append(value)
+        return codes.get(value, -1)
+
+    def equals(self, field: str, value: str) -> np.ndarray:
+        """Sorted ids of the images whose categorical `field` is `value`."""
+        code = self.category_code(field, value)
+        if code < 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.flatnonzero(self.codes[field] == code).astype(np.uint32)
+
+    def in_subfolder(self, subfolder: str) -> np.ndarray:
+        """Sorted ids of the images with `subfolder` anywhere in their path below the dataset root."""
+        return np.fromiter(
+            (
+                image_id
+                for image_id, path in enumerate(self.paths)
+                if path is not None and subfolder in path.split("/")[:-1]
+            ),
+            dtype=np.uint32,
+        )
+
+    def from_keys(self, keys: Iterator[Optional[str]]) -> np.ndarray:
+        """Sorted ids of the images with the given keys (as listed by another index)."""
+        return np.unique(np.fromiter((self.ids[key] for key in keys if key in self.ids), dtype=np.uint32))
+
+
+COMPARISONS = {ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=", ast.Eq: "==", ast.NotEq: "!="}
+# The comparison that means the same with its operands swapped, e.g. `5 < x` is `x > 5`
+FLIPPED = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+
+class Where:
+    """A parsed `--where` expression, evaluated against a `MetadataIndex` (and the dataset's `TagIndex` for tags).
+
+    Supports `and`, `or`, `not`, (chained) comparisons of numeric fields with numbers, `field == 'value'` for
+    categorical fields, `field == None` for missing fields, and `'tag' in tags` / `'name' in subfolders`.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            self.tree = ast.parse(expression, mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid expression {expression!r}: {e.msg}") from e
+
+    def evaluate(self, index: MetadataIndex, tag_index: Optional[TagIndex]) -> np.ndarray:
+        """Sorted ids of the matching images."""
+        return self._evaluate(self.tree, index, tag_index)
+
+    def _evaluate(self, node: ast.expr, index: MetadataIndex, tag_index: Optional[TagIndex]) -> np.ndarray:
+        if isinstance(node, ast.BoolOp):
+            results = [self._evaluate(value, index, tag_index) for value in node.values]
+            combine = np.intersect1d if isinstance(node.op, ast.And) else np.union1d
+            result = results[0]
+            for other in results[1:]:
+                result = combine(result, other)
+            return result
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return np.setdiff1d(index.live_ids(), self._evaluate(node.operand, index, tag_index), assume_unique=True)
+        if isinstance(node, ast.Compare):
+            # Chained comparisons like `4 < x < 6` are each pair of neighbouring operands, and-ed together
+            operands = [node.left, *node.comparators]
+            result = None
+            for left, operator, right in zip(operands, node.ops, operands[1:]):
+                matches = self._compare(left, operator, right, index, tag_index)
+                result = matches if result is None else np.intersect1d(result, matches)
+            return result
+        raise ValueError(f"Unsupported expression {ast.unparse(node)!r} in {self.expression!r}")
+
+    def _compare(
+        self, left: ast.expr, operator: ast.cmpop, right: ast.expr, index: MetadataIndex, tag_index: Optional[TagIndex]
+    ) -> np.ndarray:
+        if isinstance(operator, (ast.In, ast.NotIn)):
+            matches = self._membership(left, right, index, tag_index)
+            if isinstance(operator, ast.NotIn):
+                return np.setdiff1d(index.live_ids(), matches, assume_unique=True)
+            return matches
+
+        if type(operator) not in COMPARISONS:
+            raise ValueError(f"Unsupported comparison in {self.expression!r}")
+        symbol = COMPARISONS[type(operator)]
+        if isinstance(right, ast.Name) and isinstance(left, ast.Constant):
+            left, right, symbol = right, left, FLIPPED[symbol]
+        if not isinstance(left, ast.Name) or not isinstance(right, ast.Constant):
+            raise ValueError(f"Comparisons must be between a field and a constant in {self.expression!r}")
+
+        field, value = left.id, right.value
+        if value is None and symbol in ("==", "!="):
+            missing = index.missing(field)
+            return missing if symbol == "==" else np.setdiff1d(index.live_ids(), missing, assume_unique=True)
+        if isinstance(value, str) and field in CATEGORICAL_FIELDS and symbol in ("==", "!="):
+            matches = index.equals(field, value)
+            if symbol == "==":
+                return matches
+            return np.setdiff1d(np.setdiff1d(index.live_ids(), matches), index.missing(field), assume_unique=True)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return index.range(field, symbol, value)
+        raise ValueError(f"Can't compare {field} with {value!r} in {self.expression!r}")
+
+    def _membership(
+        self, left: ast.expr, right: ast.expr, index: MetadataIndex, tag_index: Optional[TagIndex]
+    ) -> np.ndarray:
+        if not isinstance(left, ast.Constant) or not isinstance(left.value, str) or not isinstance(right, ast.Name):
+            raise ValueError(f"Membership tests must look like 'value' in tags in {self.expression!r}")
+        if right.id == "subfolders":
+            return index.in_subfolder(left.value)
+        if right.id == "tags":
+            if tag_index is None:
+                raise ValueError("Tag predicates need a tag index")
+            return index.from_keys(tag_index.paths[image_id] for image_id in tag_index.postings(left.value))
+        raise ValueError(f"Can only test membership in tags or subfolders in {self.expression!r}")
+
+    def uses_tags(self) -> bool:
+        return any(isinstance(node, ast.Name) and node.id == "tags" for node in ast.walk(self.tree))
+
+
+def select(dataset: DatasetDirectory, where: str) -> Iterator[Image]:
+    """Lazily yields the images of a dataset matching a `--where` expression, in path order.
+
+    Only the metadata of images that changed since the indexes were last updated is read, so the metadata of
+    unmatched images isn't loaded at all.
+    """
+    condition = Where(where)
+    index = MetadataIndex.load(dataset.path)
+    images = index.refresh(dataset)
+
+    tag_index = None
+    if condition.uses_tags():
+        tag_index = dataset.tag_index if dataset.tag_index is not None else TagIndex(dataset.path)
+        if tag_index.refresh(dataset):
+            tag_index.save()
+
+    matches = condition.evaluate(index, tag_index)
+    for key in sorted(index.paths[image_id] for image_id in matches):  # type: ignore[type-var]
+        yield images[key]
+
+
+@app.command()
+def main(
+    data_dir: str = typer.Argument(..., help="Dataset directory"),
+    where: str = typer.Argument(..., help="Expression selecting images, e.g. \"aesthetic_score > 6 and 'x' in tags\""),
+    count: bool = typer.Option(False, "--count", "-c", help="Only print the number of matching images"),
+) -> None:
+    """List the images in a dataset matching an expression."""
+    dataset = DatasetDirectory(data_dir, lazy=True)
+    try:
+        matches = select(dataset, where)
+        if count:
+            typer.echo(sum(1 for _ in matches))
+            return
+        for image in matches:
+            typer.echo(image.path)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from e
+
+
+if __name__ == "__main__":
+    app()
@@ -1,32 +1,135 @@
-"""CLI utility that looks at the tags for each image, and if one is a subset of another, removes it."""
+"""CLI utility that looks at the tags for each image, and if one is a subset of another, removes it.
 
+Tags are compared case-insensitively. A tag is removed if it appears inside a longer tag of the same image, or if
+an earlier tag is the same apart from case. The result doesn't depend on the order tags are checked in.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Set
+
+import tqdm
 import typer
 
 from dataset import DatasetDirectory, Image
 
 app = typer.Typer()
 
+
+class AhoCorasick:
+    """Multi-pattern string matcher: finds which of a set of patterns occur in a text in one pass over the text.
+
+    Built with the usual goto/failure links, plus dictionary links pointing to the next pattern that ends at the same
+    position, so matches are found without walking every failure link.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.goto: List[Dict[str, int]] = [{}]
+        self.output: List[int] = [-1]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.output.append(-1)
+                node = next_node
+            self.output[node] = index
+
+        self.fail = [0] * len(self.goto)
+        self.dictionary_link = [-1] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                suffix = self.fail[child]
+                self.dictionary_link[child] = suffix if self.output[suffix] >= 0 else self.dictionary_link[suffix]
+                queue.append(child)
+
+    def find(self, text: str, found: Set[int]) -> None:
+        """Adds the indices of the patterns occurring in `text`, other than `text` itself, to `found`.
+
+        Patterns already in `found` are assumed to have been added along with all their suffixes, which lets the
+        search stop following dictionary links early.
+        """
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            match = node if self.output[node] >= 0 else self.dictionary_link[node]
+            while match >= 0:
+                index = self.output[match]
+                if index in found:
+                    break
+                if self.patterns[index] != text:
+                    found.add(index)
+                match = self.dictionary_link[match]
+
+
+def find_subset_tags(tags: List[str]) -> List[str]:
+    """Returns the tags that are contained in another (longer) tag, or repeat an earlier tag apart from case."""
+    first_by_lowercase: Dict[str, str] = {}
+    repeated: List[str] = []
+    for tag in tags:
+        if first_by_lowercase.setdefault(tag.lower(), tag) is not tag:
+            repeated.append(tag)
+
+    # Longest first, since a tag can only contain shorter tags
+    lowercase = sorted(first_by_lowercase, key=len, reverse=True)
+    matcher = AhoCorasick(lowercase)
+    contained: Set[int] = set()
+    for text in lowercase:
+        matcher.find(text, contained)
+
+    removed = {first_by_lowercase[lowercase[index]] for index in contained}
+    return [tag for tag in tags if tag in removed] + repeated
+
+
+def remove_subset_tags(image: Image) -> bool:
+    """Removes tags from an image that are subsets of other tags, returning whether any were removed."""
+    to_remove = find_subset_tags(list(image.tags))
+    for tag in to_remove:
+        typer.echo(f"Removing tag '{tag}' from {image.path}")
+        image.remove_tag(tag)
+    return bool(to_remove)
+
+
 def process_image(image: Image) -> None:
     """Removes tags from an image that are subsets of other tags."""
-    tags = image.tags
-    removed = False
-    for tag in tags:
-        if any(tag.lower() in other.lower() for other in tags if other != tag):
-            typer.echo(f"Removing tag '{tag}' from {image.path}")
-            image.remove_tag(tag)
-            removed = True
-    
-    if removed:
+    if remove_subset_tags(image):
         image.save_metadata()
 
+
 @app.command()
-def main(dataset_path: str):
+def main(
+    dataset_path: str,
+    workers: int = typer.Option(8, help="Number of processes to check images with"),
+):
     """Removes tags from images that are subsets of other tags."""
     dataset = DatasetDirectory(dataset_path)
-    for image in dataset.images:
-        process_image(image)
+    dataset.load_metadata()
+    if workers <= 1:
+        for image in tqdm.tqdm(dataset.images):
+            process_image(image)
+        dataset.flush()
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        tag_lists = (list(image.tags) for image in dataset.images)
+        results = executor.map(find_subset_tags, tag_lists, chunksize=256)
+        for image, to_remove in tqdm.tqdm(zip(dataset.images, results), total=len(dataset)):
+            for tag in to_remove:
+                typer.echo(f"Removing tag '{tag}' from {image.path}")
+                image.remove_tag(tag)
+    typer.echo(f"Removed tags from {dataset.flush()} images")
+
 
 if __name__ == "__main__":
     app()
-
-        
\ No newline at end of file
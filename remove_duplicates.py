@@ -1,34 +1,214 @@
-"""Script to find (and optionally remove) duplicate images (and associated metadata files) recursively through a dataset."""
+"""Script to find (and optionally remove) duplicate images (and associated metadata files) recursively through a dataset.
+
+By default only byte-identical files are duplicates. With --perceptual, images whose perceptual hashes are within
+--max-distance bits of each other are too, which catches re-encoded and resized copies.
+"""
 
 import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 import typer
+from PIL import Image as PILImage
+
+from dataset import IMAGE_EXTENSIONS
+from metadata_store import STATE_DIR
 
 app = typer.Typer()
 
+READ_SIZE = 1 << 20
+# Bytes hashed from each end of a file when checking whether same-sized files could be duplicates
+SAMPLE_SIZE = 64 * 1024
+
 
 def get_hash(file_path: str) -> str:
     """Get the hash of a file."""
     with open(file_path, "rb") as f:
         file_hash = hashlib.sha256()
-        while chunk := f.read(8192):
+        while chunk := f.read(READ_SIZE):
             file_hash.update(chunk)
     return file_hash.hexdigest()
 
 
-def find_duplicates(dir_path: str) -> dict:
-    """Find duplicate images in a directory."""
-    hashes = {}
-    for root, _, files in os.walk(dir_path):
+def get_sample_hash(file_path: str) -> str:
+    """Get the hash of the start and end of a file, which tells most same-sized files apart without reading them."""
+    with open(file_path, "rb") as f:
+        file_hash = hashlib.sha256(f.read(SAMPLE_SIZE))
+        size = os.fstat(f.fileno()).st_size
+        if size > SAMPLE_SIZE:
+            f.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            file_hash.update(f.read(SAMPLE_SIZE))
+    return file_hash.hexdigest()
+
+
+def group_by_size(dir_path: str) -> Dict[int, List[str]]:
+    """Group the files in a directory (recursively) by size, skipping metadata sidecars."""
+    sizes: Dict[int, List[str]] = {}
+    for root, dirs, files in os.walk(dir_path):
+        if root == dir_path and STATE_DIR in dirs:
+            dirs.remove(STATE_DIR)
         for file in files:
+            if file.endswith(".json"):
+                continue
             file_path = os.path.join(root, file)
-            file_hash = get_hash(file_path)
-            if file_hash in hashes:
-                hashes[file_hash].append(file_path)
-            else:
-                hashes[file_hash] = [file_path]
-    return {k: v for k, v in hashes.items() if len(v) > 1}
+            sizes.setdefault(os.path.getsize(file_path), []).append(file_path)
+    return sizes
+
+
+def split_groups(
+    groups: List[List[str]], hash_function: Callable[[str], str], executor: ThreadPoolExecutor
+) -> List[Tuple[str, List[str]]]:
+    """Split groups of possible duplicates by hashing their files in a thread pool, keeping files in order."""
+    file_paths = [file_path for group in groups for file_path in group]
+    group_indices = [group_index for group_index, group in enumerate(groups) for _ in group]
+    split: Dict[Tuple[int, str], List[str]] = {}
+    for group_index, file_path, file_hash in zip(group_indices, file_paths, executor.map(hash_function, file_paths)):
+        split.setdefault((group_index, file_hash), []).append(file_path)
+    return [(file_hash, group) for (_, file_hash), group in split.items()]
+
+
+def find_duplicates(dir_path: str, workers: int = 8) -> dict:
+    """Find duplicate images in a directory.
+
+    Files are grouped by size first, then by a hash of their start and end, and only files that still collide get
+    hashed in full. Most files have a unique size, so most bytes are never read.
+    """
+    candidates = [group for group in group_by_size(dir_path).values() if len(group) > 1]
+    with ThreadPoolExecutor(workers) as executor:
+        sampled = split_groups(candidates, get_sample_hash, executor)
+        candidates = [group for _, group in sampled if len(group) > 1]
+        hashes = split_groups(candidates, get_hash, executor)
+    return {k: v for k, v in hashes if len(v) > 1}
+
+
+def get_perceptual_hash(file_path: str, hash_size: int = 8) -> Optional[int]:
+    """Get the difference hash (dHash) of an image as a `hash_size ** 2` bit integer, or None if it can't be read.
+
+    Each bit says whether a pixel of the downscaled grayscale image is brighter than its right-hand neighbour, so the
+    hash survives re-encoding, resizing and small colour shifts.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    try:
+        with PILImage.open(file_path) as image:
+            image.draft("L", (hash_size * 8, hash_size * 8))
+            pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), PILImage.BOX), dtype=np.int16)
+    except (OSError, ValueError):
+        return None
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).flatten())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def popcount(values):
+    """Number of set bits in each element of an array of uint64s."""
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class MultiIndexHash:
+    """Index for finding 64-bit hashes within a Hamming distance of each other without comparing every pair.
+
+    Hashes are split into `max_distance + 1` chunks, and indexed by each chunk. Two hashes within `max_distance` bits
+    of each other must agree exactly on at least one chunk (pigeonhole principle), so only hashes sharing a chunk need
+    their full distance checked.
+    """
+
+    def __init__(self, max_distance: int, bits: int = 64):
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        self.max_distance = max_distance
+        chunk_count = max_distance + 1
+        bounds = [bits * i // chunk_count for i in range(chunk_count + 1)]
+        self.chunks = [(start, end - start) for start, end in zip(bounds, bounds[1:])]
+        self.buckets: List[Dict[int, List[int]]] = [{} for _ in self.chunks]
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.count = 0
+
+    def _chunk_values(self, value: int) -> List[int]:
+        return [(value >> start) & ((1 << width) - 1) for start, width in self.chunks]
+
+    def query(self, value: int) -> List[int]:
+        """Returns the ids of indexed hashes within `max_distance` bits of `value`."""
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        candidates = set()
+        for buckets, chunk_value in zip(self.buckets, self._chunk_values(value)):
+            candidates.update(buckets.get(chunk_value, ()))
+        if not candidates:
+            return []
+        ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        distances = popcount(self.hashes[ids] ^ np.uint64(value))
+        return ids[distances <= self.max_distance].tolist()
+
+    def add(self, value: int) -> int:
+        """Indexes a hash, returning its id."""
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        if self.count == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+        item_id = self.count
+        self.hashes[item_id] = value
+        self.count += 1
+        for buckets, chunk_value in zip(self.buckets, self._chunk_values(value)):
+            buckets.setdefault(chunk_value, []).append(item_id)
+        return item_id
+
+
+def group_connected(pairs: List[Tuple[int, int]], count: int) -> List[List[int]]:
+    """Groups ids connected by pairs (union-find), returning groups of more than one id, each in ascending order."""
+    parents = list(range(count))
+
+    def find(item: int) -> int:
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups: Dict[int, List[int]] = {}
+    for item in range(count):
+        groups.setdefault(find(item), []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_images(dir_path: str) -> List[str]:
+    """All images in a directory (recursively), skipping the dataset's bookkeeping directory."""
+    images = []
+    for root, dirs, files in os.walk(dir_path):
+        if root == dir_path and STATE_DIR in dirs:
+            dirs.remove(STATE_DIR)
+        images.extend(os.path.join(root, file) for file in files if file.endswith(IMAGE_EXTENSIONS))
+    return images
+
+
+def find_near_duplicates(dir_path: str, max_distance: int = 4, workers: int = 8) -> dict:
+    """Find groups of images whose perceptual hashes are within `max_distance` bits of each other.
+
+    Groups are transitive (if A matches B and B matches C, all three are one group) and keep walk order, so removal
+    keeps the first image like it does for exact duplicates.
+    """
+    file_paths = find_images(dir_path)
+    with ProcessPoolExecutor(workers) as executor:
+        hashes = list(executor.map(get_perceptual_hash, file_paths, chunksize=64))
+
+    readable = [(file_path, value) for file_path, value in zip(file_paths, hashes) if value is not None]
+    index = MultiIndexHash(max_distance)
+    pairs: List[Tuple[int, int]] = []
+    for file_path, value in readable:
+        matches = index.query(value)
+        item_id = index.add(value)
+        pairs.extend((match, item_id) for match in matches)
+
+    return {
+        f"{readable[group[0]][1]:016x}": [readable[item][0] for item in group]
+        for group in group_connected(pairs, len(readable))
+    }
 
 
 def remove_duplicates(duplicates: dict) -> None:
@@ -44,9 +224,15 @@ def remove_duplicates(duplicates: dict) -> None:
 def main(
     dir_path: str = typer.Argument(..., help="Path to the directory to find duplicates in"),
     remove: bool = typer.Option(False, "--remove", "-r", help="Remove duplicate images"),
+    workers: int = typer.Option(8, help="Number of threads (or processes, with --perceptual) to hash files with"),
+    perceptual: bool = typer.Option(False, help="Also treat visually similar images (e.g. resized copies) as dupes"),
+    max_distance: int = typer.Option(4, help="Maximum number of differing perceptual hash bits for --perceptual"),
 ):
     """Find (and optionally remove) duplicate images (and associated metadata files) recursively through a dataset."""
-    duplicates = find_duplicates(dir_path)
+    if perceptual:
+        duplicates = find_near_duplicates(dir_path, max_distance, workers)
+    else:
+        duplicates = find_duplicates(dir_path, workers)
     if duplicates:
         typer.echo(f"Found {len(duplicates)} duplicate images:")
         for duplicate in duplicates.values():
@@ -1,38 +1,54 @@
 """CLI Utility that filters images below a certain aesthetic score."""
 
-import os
+from typing import Optional
 
 import tqdm
 import typer
 
 from dataset import DatasetDirectory, Image
+from query import select
 
 app = typer.Typer()
 
 
+def is_low_quality(image: Image, min_score: float, remove_invalid: bool) -> bool:
+    """Whether an image scores below `min_score` (or, with `remove_invalid`, has no aesthetic score at all)."""
+    if "aesthetic_score" not in image.metadata:
+        if not remove_invalid:
+            typer.echo(f"No aesthetic score for {image.path}, skipping...")
+        return remove_invalid
+    return image.metadata["aesthetic_score"] < min_score
+
+
 @app.command()
 def main(
     data_dir: str = typer.Argument(..., help="Directory to process"),
-    min_score: float = typer.Argument(..., help="Minimum aesthetic score to filter by"),
+    min_score: Optional[float] = typer.Argument(None, help="Minimum aesthetic score to filter by"),
     remove_invalid: bool = typer.Option(False, help="Remove images missing an aesthetic score (such as broken images)"),
+    where: Optional[str] = typer.Option(
+        None, help="Only remove images matching this expression (see query.py), e.g. \"'reg' not in subfolders\""
+    ),
 ) -> None:
+    if min_score is None and where is None:
+        raise typer.BadParameter("Give a minimum score, a --where expression, or both")
     dataset = DatasetDirectory(data_dir)
 
-    images_to_delete: list[Image] = []
-
-    for image in tqdm.tqdm(dataset):
-        if "aesthetic_score" not in image.metadata:
-            if remove_invalid:
-                images_to_delete.append(image)
-                continue
-            typer.echo(f"No aesthetic score for {image.path}, skipping...")
-            continue
-        if image.metadata["aesthetic_score"] < min_score:
-            images_to_delete.append(image)
+    images_to_delete: list[Image]
+    if where is not None:
+        # Selected from the dataset's indexes, so images that don't match are never loaded
+        conditions = [f"({where})"]
+        if min_score is not None:
+            score_condition = f"aesthetic_score < {min_score!r}"
+            conditions.append(f"({score_condition} or aesthetic_score == None)" if remove_invalid else score_condition)
+        images_to_delete = list(select(dataset, " and ".join(conditions)))
+    else:
+        assert min_score is not None
+        dataset.load_metadata()
+        images_to_delete = [image for image in tqdm.tqdm(dataset) if is_low_quality(image, min_score, remove_invalid)]
 
     percentage = (len(images_to_delete) / len(dataset)) * 100.0
     prompt = (
-        f"Filtering {data_dir} by aesthetic score {min_score} would delete "
+        f"Filtering {data_dir} by {where or f'aesthetic score {min_score}'} would delete "
         f"{len(images_to_delete)}/{len(dataset)} ({percentage:.2f}%), continue?"
     )
     delete = typer.confirm(prompt)
@@ -40,8 +56,8 @@ def main(
         return
 
     for image in tqdm.tqdm(images_to_delete):
-        os.remove(image.path)
-        os.remove(image.metadata_path)
+        image.delete()
+    dataset.flush()
 
     typer.echo(f"Deleted {len(images_to_delete)} images")
 
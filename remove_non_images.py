@@ -14,7 +14,11 @@ def remove_non_images(directory: Path = typer.Argument(..., exists=True, file_ok
     """Removes non-image files from a directory recursively, prompting the user before deleting."""
     files_to_delete: list[Path] = []
     for root, dirs, files in os.walk(directory):
+        # Hidden files and directories are the dataset's own bookkeeping (e.g. the metadata database)
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
         for file in files:
+            if file.startswith("."):
+                continue
             file_path = Path(root, file)
             if all(
                 [suffix not in [".jpg", ".jpeg", ".png", ".bmp", ".webp", ".json"] for suffix in file_path.suffixes]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+CLI utility that finds (and optionally removes) images that are semantically near-identical, such as crops and
+recolors of the same photo, by comparing their CLIP embeddings.
+
+Embeddings come from the on-disk embedding cache (filled by predict_aesthetic_score.py, or computed here for images
+missing from it). From each group of similar images, the one with the highest aesthetic score is kept.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import tqdm
+import typer
+
+from dataset import DatasetDirectory, Image
+from embedding_cache import DEFAULT_CACHE_DIR, EmbeddingCache, file_hashes
+from model_registry import CLIP_MODEL, model_errors
+
+app = typer.Typer()
+
+
+def normalized_rows(cache: EmbeddingCache, rows: np.ndarray) -> np.ndarray:
+    """Loads rows of the embedding matrix as unit length float32 vectors."""
+    block = np.asarray(cache.matrix[rows], dtype=np.float32)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return block / norms
+
+
+def find_roots(parents: np.ndarray, items: np.ndarray) -> np.ndarray:
+    """Finds the roots of several items in a union-find parent array at once, compressing their paths."""
+    roots = parents[items]
+    while not np.array_equal(next_roots := parents[roots], roots):
+        roots = next_roots
+    parents[items] = roots
+    return roots
+
+
+def group_similar(
+    cache: EmbeddingCache, rows: List[int], threshold: float, block_size: int = 4096
+) -> List[List[int]]:
+    """Groups indices into `rows` connected by embeddings with a cosine similarity above `threshold`, returning groups
+    of more than one index, each in ascending order.
+
+    The similarity matrix is computed one `block_size` x `block_size` block at a time (upper triangle only), reading
+    embeddings straight from the memory-mapped cache, and similar images are merged (union-find) as each block is
+    processed. Only the parent array is kept, so memory use doesn't grow with the size of the dataset or of a cluster.
+    """
+    row_array = np.asarray(rows, dtype=np.int64)
+    parents = np.arange(len(rows), dtype=np.int64)
+    starts = range(0, len(rows), block_size)
+    with tqdm.tqdm(total=len(starts) * (len(starts) + 1) // 2) as progress:
+        for i in starts:
+            block_a = normalized_rows(cache, row_array[i : i + block_size])
+            for j in starts:
+                if j < i:
+                    continue
+                block_b = block_a if j == i else normalized_rows(cache, row_array[j : j + block_size])
+                similar = block_a @ block_b.T > threshold
+                if j == i:
+                    # Never an image with itself
+                    similar = np.triu(similar, k=1)
+                for a in np.flatnonzero(similar.any(axis=1)):
+                    # Merges all of the image's matches at once. Once a cluster is merged its roots are all the same,
+                    # so dense clusters cost one root lookup per image rather than per pair
+                    roots = np.unique(find_roots(parents, np.append(j + np.flatnonzero(similar[a]), i + a)))
+                    parents[roots] = roots[0]
+                progress.update()
+
+    groups: Dict[int, List[int]] = {}
+    for item, root in enumerate(find_roots(parents, np.arange(len(rows))).tolist()):
+        groups.setdefault(root, []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def embed_missing(images: List[Image], cache: EmbeddingCache, batch_size: int, num_workers: int) -> Dict[Image, float]:
+    """Computes (and caches) embeddings for images missing from the cache, returning their aesthetic scores."""
+    # pylint: disable=import-outside-toplevel
+    import torch
+
+    from aesthetic_model import get_aesthetic_scores, load_clip, load_mlp
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    with model_errors():
+        clip_model, preprocess = load_clip(device)
+        mlp = load_mlp(device)
+    scores = get_aesthetic_scores(images, clip_model, mlp, preprocess, device, batch_size, num_workers, cache)
+    return {image: score for image, score in tqdm.tqdm(scores, total=len(images)) if score is not None}
+
+
+@app.command()
+def main(
+    data_dir: str = typer.Argument(..., help="Path to the dataset directory"),
+    threshold: float = typer.Option(0.95, help="Cosine similarity above which two images count as duplicates"),
+    remove: bool = typer.Option(False, "--remove", "-r", help="Remove all but the best image of each group"),
+    cache_dir: str = typer.Option(str(DEFAULT_CACHE_DIR), help="Directory of the embedding cache"),
+    block_size: int = typer.Option(4096, help="Number of embeddings compared against each other at once"),
+    batch_size: int = typer.Option(32, help="Batch size for computing missing embeddings"),
+    num_workers: int = typer.Option(4, help="Number of worker processes for computing missing embeddings"),
+) -> None:
+    """Find (and optionally remove) groups of semantically near-identical images, keeping the best of each."""
+    dataset = DatasetDirectory(data_dir)
+    dataset.load_metadata()
+    hashes = file_hashes([image.path for image in dataset])
+
+    with EmbeddingCache(cache_dir, CLIP_MODEL, wait=True) as cache:
+        missing = [image for image, content_hash in zip(dataset, hashes) if content_hash and content_hash not in cache]
+        computed_scores: Dict[Image, float] = {}
+        if missing:
+            typer.echo(f"Computing embeddings for {len(missing)} images missing from the cache")
+            computed_scores = embed_missing(missing, cache, batch_size, num_workers)
+
+        embedded = [
+            (image, content_hash)
+            for image, content_hash in zip(dataset, hashes)
+            if content_hash is not None and content_hash in cache
+        ]
+        rows = [cache.row(content_hash) for _, content_hash in embedded]
+        groups = group_similar(cache, rows, threshold, block_size)
+
+    def score(image: Image) -> float:
+        found: Optional[float] = image.metadata.get("aesthetic_score", computed_scores.get(image))
+        return found if found is not None else float("-inf")
+
+    if not groups:
+        typer.echo("No semantic duplicates found")
+        return
+
+    typer.echo(f"Found {len(groups)} groups of semantic duplicates:")
+    to_remove: List[Image] = []
+    for group in groups:
+        images = [embedded[item][0] for item in group]
+        best = max(images, key=score)
+        typer.echo(f"Keeping {best.path}, duplicates: {[str(image.path) for image in images if image is not best]}")
+        to_remove.extend(image for image in images if image is not best)
+
+    if remove:
+        for image in tqdm.tqdm(to_remove):
+            image.delete()
+        dataset.flush()
+        typer.echo(f"Removed {len(to_remove)} images")
+
+
+if __name__ == "__main__":
+    app()
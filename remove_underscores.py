@@ -8,11 +8,15 @@ from dataset import DatasetDirectory, Image
 app = typer.Typer()
 
 
-def process_image(image: Image) -> None:
+def remove_underscores(image: Image) -> bool:
+    """Replaces underscores in an image's tags with spaces, returning whether any tags changed."""
     old_tags = image.tags
     image.tags = [tag.replace("_", " ") for tag in image.tags]
+    return old_tags != image.tags
+
 
-    if old_tags != image.tags:
+def process_image(image: Image) -> None:
+    if remove_underscores(image):
         typer.echo(f"Removing underscores from tags in {image.path}")
         image.save_metadata()
 
@@ -21,8 +25,10 @@ def process_image(image: Image) -> None:
 def main(dataset_path: str):
     """Removes underscores from tags."""
     dataset = DatasetDirectory(dataset_path)
+    dataset.load_metadata()
     for image in tqdm.tqdm(dataset):
         process_image(image)
+    dataset.flush()
 
 
 if __name__ == "__main__":
@@ -1,19 +1,30 @@
 """
 Script that scrapes the H&M website for images, saving them in a directory along with metadata
 containing their gender, category, and caption.
+
+With --concurrent, listing pages and images for all categories are fetched at the same time over a pool of keep-alive
+connections (at most --concurrency in total and --per-host to each host) through the shared downloader (see
+downloader.py), and pages are parsed in a thread so parsing doesn't hold up downloads. --base-url points the scraper
+at another server, like a local stand-in serving saved pages, and image URLs in its pages are then fetched from that
+server too (or from --image-host).
 """
 
+import asyncio
 import json
 import mimetypes
 import os
 import re
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import List, Optional
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
+import aiohttp
 import requests
 import typer
 from bs4 import BeautifulSoup
 
+from downloader import Downloader
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/601.3.9 (KHTML, like Gecko) Version/9.0.2 Safari/601.3.9"
 }
@@ -79,8 +90,8 @@ class Item:
     category: str
 
 
-def get_url(category_url: str, page_size: int, page: int) -> str:
-    url = f"{BASE_URL}{category_url}{BASE_URL_QUERY}"
+def get_url(category_url: str, page_size: int, page: int, base_url: str = BASE_URL) -> str:
+    url = f"{base_url}{category_url}{BASE_URL_QUERY}"
     url_with_page_size = f"{url}&page-size={page_size}"
     url_with_offset = f"{url_with_page_size}&offset={page_size * page}"
     return url_with_offset
@@ -95,10 +106,19 @@ def write_item(item: Item, image_data: bytes, directory: str, extension: str) ->
         json.dump({"category": item.category, "title": item.name, "source": "h&m"}, f)
 
 
-def scrape_url(url: str, image_count: int, category: str) -> List[Item]:
-    print(f"Fetching {image_count} images from {category} - {url}")
-    response = requests.get(get_url(url, image_count, 0), headers=HEADERS)
-    soup = BeautifulSoup(response.content, "lxml")
+def origin(url: str) -> str:
+    """The scheme and host of a URL, e.g. "http://127.0.0.1:8000"."""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, "", "", ""))
+
+
+def parse_listing(
+    content: bytes, category: str, base_url: str = BASE_URL, image_host: Optional[str] = None
+) -> List[Item]:
+    """Parses the items out of a category's listing page.
+
+    Image URLs point at H&M's image host, unless `image_host` (a scheme and host) is given to replace it."""
+    soup = BeautifulSoup(content, "lxml")
 
     items: List[Item] = []
     for scraped_item in soup.select(".hm-product-item"):
@@ -106,7 +126,12 @@ def scrape_url(url: str, image_count: int, category: str) -> List[Item]:
         raw_image_url = scraped_item.select(".item-image")[0]["data-src"]
         if not isinstance(raw_image_url, str):
             raise ValueError(f"Image URL for {name} is not a string: {raw_image_url}")
-        image_url = "https:" + raw_image_url
+        # Image URLs are protocol relative ("//image.hm.com/..."), so they get the listing page's scheme
+        image_url = urljoin(base_url, raw_image_url)
+        if image_host is not None:
+            parts = urlsplit(image_url)
+            host = urlsplit(image_host)
+            image_url = urlunsplit((host.scheme, host.netloc, parts.path, parts.query, parts.fragment))
 
         # Replace res[s/m] with res[l]
         image_url = re.sub(r"res[s|m]", "resl", image_url)
@@ -121,6 +146,14 @@ def scrape_url(url: str, image_count: int, category: str) -> List[Item]:
     return items
 
 
+def scrape_url(
+    url: str, image_count: int, category: str, base_url: str = BASE_URL, image_host: Optional[str] = None
+) -> List[Item]:
+    print(f"Fetching {image_count} images from {category} - {url}")
+    response = requests.get(get_url(url, image_count, 0, base_url), headers=HEADERS)
+    return parse_listing(response.content, category, base_url, image_host)
+
+
 def fetch_images(items: List[Item], data_dir: str) -> None:
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
@@ -140,14 +173,110 @@ def fetch_images(items: List[Item], data_dir: str) -> None:
         write_item(item, response.content, data_dir, extension)
 
 
+async def fetch_image_async(item: Item, data_dir: str, downloader: Downloader) -> bool:
+    print(f"Fetching {item.name} - {item.image_url}")
+    response = await downloader.get(item.image_url)
+    if response is None:
+        return False
+    if not response.ok:
+        print(f"Failed to download image for {item.name} - {response.status}")
+        return False
+    extension = mimetypes.guess_extension(response.headers.get("Content-Type", ""))
+    if extension is None:
+        print(f"Could not determine extension for {item.name}")
+        return False
+
+    await asyncio.get_running_loop().run_in_executor(None, write_item, item, response.body, data_dir, extension)
+    return True
+
+
+async def scrape_category_async(
+    category_url: str,
+    category: str,
+    count: int,
+    output_dir: str,
+    base_url: str,
+    image_host: Optional[str],
+    downloader: Downloader,
+) -> int:
+    """Fetches a category's listing, then all of its images at once (the downloader limits how many actually run)."""
+    url = get_url(category_url, count, 0, base_url)
+    print(f"Fetching {count} images from {category} - {url}")
+    response = await downloader.get(url)
+    if response is None:
+        return 0
+    if not response.ok:
+        print(f"Failed to fetch {category} - {response.status}")
+        return 0
+
+    items = await asyncio.get_running_loop().run_in_executor(
+        None, parse_listing, response.body, category, base_url, image_host
+    )
+    data_dir = output_dir + "/" + category
+    os.makedirs(data_dir, exist_ok=True)
+    results = await asyncio.gather(*[fetch_image_async(item, data_dir, downloader) for item in items])
+    return sum(results)
+
+
+async def scrape_async(
+    output_dir: str,
+    count: int,
+    base_url: str,
+    image_host: Optional[str],
+    concurrency: int,
+    per_host: int,
+    timeout: Optional[float],
+    requests_per_second: Optional[float],
+    retries: int,
+) -> int:
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    async with aiohttp.ClientSession(
+        headers=HEADERS, connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        downloader = Downloader(session, concurrency, requests_per_second, retries)
+        results = await asyncio.gather(
+            *[
+                scrape_category_async(category_url, category, count, output_dir, base_url, image_host, downloader)
+                for category_url, category in CATEGORIES
+            ]
+        )
+    return sum(results)
+
+
 @app.command()
 def scrape(
     output_dir: str = typer.Argument(..., help="Directory to save scraped images to"),
     count: int = typer.Argument(200, help="Number of images to scrape per category"),
+    base_url: str = typer.Option(BASE_URL, help="URL the category paths are relative to"),
+    image_host: Optional[str] = typer.Option(
+        None, help="Scheme and host to fetch images from instead of the ones in the pages (default: --base-url's, "
+        "if it isn't the real site)"
+    ),
+    concurrent: bool = typer.Option(False, help="Fetch all categories and images concurrently"),
+    concurrency: int = typer.Option(32, help="Maximum number of connections open at once, with --concurrent"),
+    per_host: int = typer.Option(8, help="Maximum number of connections open to each host, with --concurrent"),
+    timeout: Optional[float] = typer.Option(300, help="Timeout for each request in seconds, with --concurrent"),
+    requests_per_second: Optional[float] = typer.Option(
+        None, help="Maximum requests per second to each host, with --concurrent"
+    ),
+    retries: int = typer.Option(5, help="Times to retry timeouts, 429s and 5xx responses, with --concurrent"),
 ):
+    if image_host is None and base_url != BASE_URL:
+        # A stand-in server's pages still link to the real image host, so its images are fetched from it instead
+        image_host = origin(base_url)
+
+    if concurrent:
+        downloaded = asyncio.run(
+            scrape_async(
+                output_dir, count, base_url, image_host, concurrency, per_host, timeout, requests_per_second, retries
+            )
+        )
+        print(f"Downloaded {downloaded} images")
+        return
+
     for category_url, category in CATEGORIES:
         print(f"Scraping {category} - {category_url}")
-        items = scrape_url(category_url, count, category)
+        items = scrape_url(category_url, count, category, base_url, image_host)
         fetch_images(items, output_dir + "/" + category)
 
 
@@ -13,6 +13,7 @@ from asyncpraw.models import Subreddit as PRAWSubreddit
 from asyncprawcore.exceptions import AsyncPrawcoreException
 
 from dataset import DatasetDirectory
+from seen_index import SeenIndex
 
 
 @dataclass
@@ -36,6 +37,26 @@ SUBREDDITS: list[Subreddit] = [
 app = typer.Typer()
 
 
+def seen_key(subreddit: str, submission_id: str, media_id: str | None = None) -> str:
+    """Key of a submission (or one image in it) in the dataset's seen index."""
+    return f"{subreddit}/{submission_id}" if media_id is None else f"{subreddit}/{submission_id}/{media_id}"
+
+
+def seed_seen_index(dataset: DatasetDirectory) -> None:
+    """Adds the submissions already in the dataset to its seen index, from their file names (`<subreddit><submission
+    id>_<media id>.<ext>`). Only needed once, for datasets scraped before the index existed."""
+    dataset.load_metadata()
+    keys = []
+    for image in dataset:
+        subreddit = image.metadata.get("subreddit")
+        if image.metadata.get("source") != "reddit" or not subreddit or not image.path.name.startswith(subreddit):
+            continue
+        submission_id, _, media_id = image.path.stem[len(subreddit) :].partition("_")
+        keys.append(seen_key(subreddit, submission_id, media_id))
+    dataset.seen.add_many(keys)
+    typer.echo(f"Seeded the seen index with {len(keys)} images already in the dataset")
+
+
 async def get_submission(
     submission: Submission,
     subreddit: PRAWSubreddit,
@@ -43,8 +64,8 @@ async def get_submission(
     dataset: DatasetDirectory,
     session: aiohttp.ClientSession,
 ) -> None:
-    if any(image.path.name.startswith(f"{subreddit.display_name}{submission.id}") for image in dataset):
-        typer.echo(f"Skipping '{submission.title}' because it already exists")
+    if seen_key(subreddit.display_name, submission.id) in dataset.seen:
+        typer.echo(f"Skipping '{submission.title}' because it was already downloaded")
         return
 
     typer.echo(f"Fetching {submission.title}")
@@ -96,7 +117,9 @@ async def get_submission(
         }
 
         try:
-            dataset.create_image(await response.read(), file_name, metadata)
+            dataset.create_image(
+                await response.read(), file_name, metadata, seen_key(subreddit.display_name, submission.id, url[1])
+            )
         except asyncio.TimeoutError:
             typer.echo(f"Error: Timeout for {submission.url}")
             return
@@ -138,6 +161,8 @@ async def scrape_subreddit(subreddit: Subreddit, reddit: asyncpraw.Reddit, datas
 async def main(data_dir: str) -> None:
     os.makedirs(data_dir, exist_ok=True)
     dataset = DatasetDirectory(data_dir)
+    if not SeenIndex.exists(data_dir):
+        seed_seen_index(dataset)
 
     with asyncpraw.Reddit(
         client_id=os.environ["REDDIT_CLIENT_ID"],
@@ -5,6 +5,8 @@ from dataclasses import dataclass
 import aiohttp
 import typer
 
+from downloader import Downloader
+
 URL = "https://vogue-street-style-prod01.k8s.us-east-1--production.containers.aws.conde.io/results"
 import asyncio
 
@@ -25,74 +27,84 @@ def process_tags(tags: list[str]) -> list[str]:
     return dedashed
 
 
-async def get_image(image: Image, output_dir: str, session: aiohttp.ClientSession) -> None:
+async def get_image(image: Image, output_dir: str, downloader: Downloader) -> None:
     file_path = os.path.join(output_dir, image.name.replace(" ", "_"))
     if os.path.exists(file_path):
         typer.echo(f"Skipping {image.url} - already exists")
         return
 
-    async with session.get(image.url) as response:
-        if response.status != 200:
-            typer.echo(f"Error downloading {image.url} - {response.status}")
-
-        try:
-            with open(file_path, "wb") as f:
-                f.write(await response.read())
-        except OSError:
-            typer.echo(f"Error saving {image.url} to {file_path}")
-            return
-
-        metadata_file_name = file_path + ".json"
-        metadata = {
-            "source": "vogue",
-            "tags": process_tags(image.tags),
-        }
-        if image.credit:
-            metadata["credit"] = (image.credit.replace("Photographed by", " ").strip(),)
-        if image.description:
-            metadata["description"] = image.description.replace("Image may contain: ", "").strip()
-
-        try:
-            with open(metadata_file_name, "w") as f:
-                json.dump(metadata, f)
-        except OSError:
-            typer.echo(f"Error saving metadata for {image.url} to {metadata_file_name}")
-            return
-
-        typer.echo(f"Downloaded {image.url} to {file_path}")
-
-
-async def get_page(page: int, size: int, filters: list[str], session: aiohttp.ClientSession) -> list[Image]:
+    response = await downloader.get(image.url)
+    if response is None:
+        return
+    if not response.ok:
+        typer.echo(f"Error downloading {image.url} - {response.status}")
+        return
+
+    try:
+        with open(file_path, "wb") as f:
+            f.write(response.body)
+    except OSError:
+        typer.echo(f"Error saving {image.url} to {file_path}")
+        return
+
+    metadata_file_name = file_path + ".json"
+    metadata = {
+        "source": "vogue",
+        "tags": process_tags(image.tags),
+    }
+    if image.credit:
+        metadata["credit"] = (image.credit.replace("Photographed by", " ").strip(),)
+    if image.description:
+        metadata["description"] = image.description.replace("Image may contain: ", "").strip()
+
+    try:
+        with open(metadata_file_name, "w") as f:
+            json.dump(metadata, f)
+    except OSError:
+        typer.echo(f"Error saving metadata for {image.url} to {metadata_file_name}")
+        return
+
+    typer.echo(f"Downloaded {image.url} to {file_path}")
+
+
+async def get_page(page: int, size: int, filters: list[str], downloader: Downloader) -> list[Image]:
     body = {"filters": filters, "page": page, "size": size}
-    async with session.post(URL, json=body) as response:
-        if response.status != 200:
-            typer.echo(f"Error getting page {page} - {response.status}")
-            return []
-
-        data = await response.json()
-        return [
-            Image(
-                name=image["imageUrlMaster"].split("/")[-1],
-                credit=image.get("photo_credit"),
-                url=image["imageUrlMaster"],
-                description=image.get("altText"),
-                tags=image["tags"] if "tags" in image else [],
-            )
-            for image in data
-        ]
+    response = await downloader.post(URL, json=body)
+    if response is None:
+        return []
+    if not response.ok:
+        typer.echo(f"Error getting page {page} - {response.status}")
+        return []
+
+    data = response.json()
+    return [
+        Image(
+            name=image["imageUrlMaster"].split("/")[-1],
+            credit=image.get("photo_credit"),
+            url=image["imageUrlMaster"],
+            description=image.get("altText"),
+            tags=image["tags"] if "tags" in image else [],
+        )
+        for image in data
+    ]
 
 
 app = typer.Typer()
 
 
-async def main(output_dir: str, filters: list[str]):
+async def main(
+    output_dir: str, filters: list[str], concurrency: int, requests_per_second: float | None, retries: int
+):
     async with aiohttp.ClientSession() as session:
+        downloader = Downloader(session, concurrency, requests_per_second, retries)
         page = 1
-        images = await get_page(page, 100, filters, session)
+        images = await get_page(page, 100, filters, downloader)
         while images:
-            await asyncio.gather(*[get_image(image, output_dir, session) for image in images])
+            # Fetched while this page's images download, so the next page's are ready to start straight away
+            next_page = asyncio.create_task(get_page(page + 1, 100, filters, downloader))
+            await asyncio.gather(*[get_image(image, output_dir, downloader) for image in images])
             page += 1
-            images = await get_page(page, 100, filters, session)
+            images = await next_page
 
 
 @app.command()
@@ -101,11 +113,14 @@ def scrape(
     filters: list[str] = typer.Argument(
         None, help="Filters to apply to the search. Suggested 'fashion-tags/street-style'"
     ),
+    concurrency: int = typer.Option(16, help="Maximum number of requests in flight at once"),
+    requests_per_second: float | None = typer.Option(None, help="Maximum requests per second to each host"),
+    retries: int = typer.Option(5, help="Times to retry timeouts, 429s and 5xx responses"),
 ) -> None:
     typer.echo(f"Saving images to {output_dir}")
     os.makedirs(output_dir, exist_ok=True)
 
-    asyncio.run(main(output_dir, filters))
+    asyncio.run(main(output_dir, filters, concurrency, requests_per_second, retries))
 
 
 if __name__ == "__main__":
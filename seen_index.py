@@ -0,0 +1,57 @@
+"""
+Persisted set of keys for everything a scraper has already downloaded, so it's never downloaded again, even after
+the image is deleted (by deduplication or quality filtering).
+
+Keys are "/"-separated (e.g. "subreddit/submission/media"), and a key also counts as seen once anything under it is,
+so a scraper can skip a whole post before finding out what's in it. Stored as an append-only log with one key per
+line in the dataset's state directory, so adding a key never rewrites the file.
+"""
+
+from pathlib import Path
+from typing import Iterable, Set, Union
+
+from metadata_store import STATE_DIR, state_path
+
+SEEN_LOG = "seen.log"
+
+
+class SeenIndex:
+    def __init__(self, root: Union[Path, str]):
+        self.root = Path(root)
+        # Every key added, along with all of their parents
+        self._seen: Set[str] = set()
+        try:
+            with open(self.root / STATE_DIR / SEEN_LOG, "r") as f:
+                for line in f:
+                    if line.endswith("\n"):  # An unterminated last line is from an interrupted write
+                        self._remember(line[:-1])
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def exists(root: Union[Path, str]) -> bool:
+        return (Path(root) / STATE_DIR / SEEN_LOG).exists()
+
+    def _remember(self, key: str) -> None:
+        parts = key.split("/")
+        for i in range(1, len(parts) + 1):
+            self._seen.add("/".join(parts[:i]))
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        new_keys = [key for key in keys if key not in self._seen]
+        # Created even with nothing to add, so `exists` tells whether the index was ever built
+        with open(state_path(self.root, SEEN_LOG), "a") as f:
+            for key in new_keys:
+                if "\n" in key:
+                    raise ValueError(f"Seen keys can't contain newlines: {key!r}")
+                f.write(f"{key}\n")
+                self._remember(key)
+
+    def add(self, key: str) -> None:
+        self.add_many([key])
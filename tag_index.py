@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Inverted index from each tag to the images that have it, stored in the dataset's state directory, so questions like
+"how many images are tagged X" or "which images are tagged both X and Y" don't need every image's metadata loaded.
+
+Each image gets a numeric id, and each tag a sorted array of the ids of images with that tag. Once a dataset has an
+index, `DatasetDirectory` keeps it up to date as tags are added and removed through `Image`, and saves it on
+`flush()`. Changes made by anything else are picked up by `refresh()`, which only rereads the metadata of images
+whose metadata was saved since they were indexed. Also a CLI for building the index and querying it.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import os
+import re
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import typer
+
+from metadata_store import STATE_DIR, atomic_write, state_path
+
+if TYPE_CHECKING:
+    from dataset import DatasetDirectory, Image
+
+TAG_INDEX = "tag_index.npz"
+TAG_INDEX_VERSION = 1
+# Images whose metadata signatures are looked up at once
+SIGNATURE_BATCH_SIZE = 1024
+
+app = typer.Typer()
+
+
+def find_changed_images(
+    dataset: DatasetDirectory,
+    key: Callable[[Path], str],
+    ids: Dict[str, int],
+    signatures: List[Optional[List[int]]],
+    full: bool = False,
+) -> Tuple[List[Tuple[Image, Optional[List[int]]]], Set[str]]:
+    """Finds the images in a dataset that need (re)indexing by an index with the given ids and metadata signatures
+    (see `MetadataStore.signatures`), without loading any metadata.
+
+    Returns each such image with its current signature (None if it has none, so it's always reindexed), and the keys
+    of all images in the dataset. With `full`, every image needs reindexing.
+    """
+    changed = []
+    seen = set()
+    images = iter(dataset)
+    while chunk := list(islice(images, SIGNATURE_BATCH_SIZE)):
+        current = dataset.store.signatures(image.path for image in chunk)
+        for image in chunk:
+            signature = current.get(image.path)
+            if signature is None and not image.path.exists():
+                # Deleted since the dataset was scanned
+                continue
+            image_key = key(image.path)
+            seen.add(image_key)
+            image_id = ids.get(image_key)
+            if full or signature is None or image_id is None or signatures[image_id] != signature:
+                changed.append((image, signature))
+    return changed, seen
+
+
+class TagIndex:
+    """Inverted index of a dataset's tags, keyed by image path relative to `root`.
+
+    Incremental changes are buffered per tag and merged into the sorted id arrays in bulk, when a tag is queried or
+    the index is saved, so tagging a whole dataset doesn't rewrite an array for every tag added.
+    """
+
+    def __init__(self, root: Union[Path, str]):
+        self.root = Path(root)
+        self.paths: List[Optional[str]] = []
+        self.ids: Dict[str, int] = {}
+        # Metadata signature of each image when it was indexed (see MetadataStore.signatures), so refresh() can skip
+        # unchanged images
+        self.signatures: List[Optional[List[int]]] = []
+        self._postings: Dict[str, np.ndarray] = {}
+        self._added: Dict[str, Set[int]] = {}
+        self._removed: Dict[str, Set[int]] = {}
+        self._deleted: Set[int] = set()
+
+    @classmethod
+    def load(cls, root: Union[Path, str]) -> TagIndex:
+        """Loads a dataset's tag index, or returns an empty one if it doesn't have one."""
+        index = cls(root)
+        try:
+            with np.load(Path(root) / STATE_DIR / TAG_INDEX) as data:
+                header = json.loads(data["header"].tobytes())
+                ids, offsets = data["ids"], data["offsets"]
+        except (OSError, ValueError, KeyError):
+            return index
+        if header.get("version") != TAG_INDEX_VERSION:
+            return index
+
+        index.paths = header["paths"]
+        index.signatures = header["signatures"]
+        index.ids = {path: image_id for image_id, path in enumerate(index.paths) if path is not None}
+        index._postings = {tag: ids[offsets[i] : offsets[i + 1]] for i, tag in enumerate(header["tags"])}
+        return index
+
+    @staticmethod
+    def exists(root: Union[Path, str]) -> bool:
+        return (Path(root) / STATE_DIR / TAG_INDEX).exists()
+
+    def save(self) -> None:
+        self._merge_all()
+        tags = list(self._postings)
+        arrays = [self._postings[tag] for tag in tags]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        header = {"version": TAG_INDEX_VERSION, "tags": tags, "paths": self.paths, "signatures": self.signatures}
+
+        with atomic_write(state_path(self.root, TAG_INDEX), "wb") as f:
+            np.savez(
+                f,
+                header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+                ids=np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint32),
+                offsets=offsets,
+            )
+
+    def key(self, image_path: Union[Path, str]) -> str:
+        return Path(os.path.relpath(image_path, self.root)).as_posix()
+
+    def image_id(self, image_path: Union[Path, str]) -> int:
+        """The id of an image, assigning it a new one if it isn't indexed yet."""
+        key = self.key(image_path)
+        image_id = self.ids.get(key)
+        if image_id is None:
+            image_id = self.ids[key] = len(self.paths)
+            self.paths.append(key)
+            self.signatures.append(None)
+        return image_id
+
+    def tag_changed(self, image_path: Union[Path, str], tag: str, added: bool) -> None:
+        """Records that a tag was added to (or removed from) an image."""
+        image_id = self.image_id(image_path)
+        self.signatures[image_id] = None
+        if added:
+            self._removed.get(tag, set()).discard(image_id)
+            self._added.setdefault(tag, set()).add(image_id)
+        else:
+            self._added.get(tag, set()).discard(image_id)
+            self._removed.setdefault(tag, set()).add(image_id)
+
+    def set_tags(self, image_path: Union[Path, str], tags: Iterable[str], previous: Iterable[str]) -> None:
+        """Records that an image's tags were replaced, given the tags it had before."""
+        tags = set(tags)
+        previous = set(previous)
+        for tag in previous - tags:
+            self.tag_changed(image_path, tag, False)
+        for tag in tags - previous:
+            self.tag_changed(image_path, tag, True)
+
+    def remove_image(self, image_path: Union[Path, str]) -> None:
+        image_id = self.ids.pop(self.key(image_path), None)
+        if image_id is not None:
+            self.paths[image_id] = None
+            self.signatures[image_id] = None
+            self._deleted.add(image_id)
+
+    def _merge(self, tag: str) -> np.ndarray:
+        postings = self._postings.get(tag, np.zeros(0, dtype=np.uint32))
+        removed = self._removed.pop(tag, set()) | self._deleted
+        if removed:
+            postings = postings[~np.isin(postings, np.fromiter(removed, dtype=np.uint32, count=len(removed)))]
+        if added := self._added.pop(tag, None):
+            postings = np.union1d(postings, np.fromiter(added, dtype=np.uint32, count=len(added)))
+        if len(postings):
+            self._postings[tag] = postings
+        else:
+            self._postings.pop(tag, None)
+        return postings
+
+    def _merge_all(self) -> None:
+        for tag in set(self._postings) | set(self._added) | set(self._removed):
+            self._merge(tag)
+        self._deleted.clear()
+
+    def postings(self, tag: str) -> np.ndarray:
+        """Sorted ids of the images with a tag."""
+        if self._deleted:
+            self._merge_all()
+        if tag in self._added or tag in self._removed:
+            return self._merge(tag)
+        return self._postings.get(tag, np.zeros(0, dtype=np.uint32))
+
+    def all_ids(self) -> np.ndarray:
+        return np.fromiter(sorted(self.ids.values()), dtype=np.uint32, count=len(self.ids))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of images with each tag."""
+        self._merge_all()
+        return {tag: len(postings) for tag, postings in self._postings.items()}
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        """The `k` most common tags and their counts."""
+        return heapq.nlargest(k, self.counts().items(), key=lambda item: item[1])
+
+    def query(self, expression: str) -> Iterator[str]:
+        """Paths (relative to the root) of the images matching a boolean tag expression, such as
+        `techwear AND (masterpiece OR 'high quality') AND NOT lowres`."""
+        for image_id in TagQuery(expression).evaluate(self):
+            yield self.paths[image_id]  # type: ignore[misc]
+
+    def reindex(self, entries: List[Tuple[str, Iterable[str], Optional[List[int]]]]) -> None:
+        """Replaces the tags of many images at once, given each image's path, tags and metadata signature.
+
+        Unlike `set_tags` this doesn't need to know the images' old tags, so it works after they changed on disk.
+        """
+        self._merge_all()
+        image_ids = [self.image_id(image_path) for image_path, _, _ in entries]
+        stale = np.asarray(image_ids, dtype=np.uint32)
+        for tag, postings in list(self._postings.items()):
+            self._postings[tag] = postings[~np.isin(postings, stale)]
+
+        for image_id, (_, tags, signature) in zip(image_ids, entries):
+            self.signatures[image_id] = signature
+            for tag in tags:
+                self._added.setdefault(tag, set()).add(image_id)
+        self._merge_all()
+
+    def refresh(self, dataset: DatasetDirectory, full: bool = False) -> int:
+        """Brings the index up to date with a dataset, returning the number of images reindexed.
+
+        Only images whose metadata signature changed since they were indexed are reloaded (every image, with `full`).
+        """
+        changed, seen = find_changed_images(dataset, self.key, self.ids, self.signatures, full)
+        for key in [key for key in self.ids if key not in seen]:
+            self.remove_image(self.root / key)
+
+        dataset.load_metadata([image for image, _ in changed])
+        self.reindex([(image.path, image.metadata.get("tags") or (), signature) for image, signature in changed])
+        return len(changed)
+
+
+class TagQuery:
+    """Boolean expression over tags: tag names combined with AND, OR, NOT and parentheses.
+
+    Words that aren't operators are joined into one tag, so `street style AND masterpiece` is two tags. Tags can also
+    be quoted, e.g. to include an operator word or a parenthesis.
+    """
+
+    OPERATORS = ("AND", "OR", "NOT")
+    TOKEN = re.compile(r"""\s*(?:([()])|'([^']*)'|"([^"]*)"|([^\s()'"]+))""")
+
+    def __init__(self, expression: str):
+        # Each token is its text and whether it's an operator (or parenthesis)
+        self.tokens: List[Tuple[str, bool]] = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.TOKEN.match(expression, position)
+            if match is None:
+                raise ValueError(f"Can't parse tag query from {expression[position:]!r}")
+            position = match.end()
+            parenthesis, single_quoted, double_quoted, word = match.groups()
+            if parenthesis or word in self.OPERATORS:
+                self.tokens.append((parenthesis or word, True))
+            elif word is not None and self.tokens and not self.tokens[-1][1]:
+                # Consecutive words form one multi-word tag
+                self.tokens[-1] = (f"{self.tokens[-1][0]} {word}", False)
+            else:
+                self.tokens.append((word if word is not None else single_quoted or double_quoted or "", False))
+        self.position = 0
+
+    def evaluate(self, index: TagIndex) -> np.ndarray:
+        """Sorted ids of the images matching the expression."""
+        self.position = 0
+        result = self._or(index)
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.position][0]!r} in tag query")
+        return result
+
+    def _peek(self) -> Optional[str]:
+        if self.position < len(self.tokens) and self.tokens[self.position][1]:
+            return self.tokens[self.position][0]
+        return None
+
+    def _or(self, index: TagIndex) -> np.ndarray:
+        result = self._and(index)
+        while self._peek() == "OR":
+            self.position += 1
+            result = np.union1d(result, self._and(index))
+        return result
+
+    def _and(self, index: TagIndex) -> np.ndarray:
+        result = self._not(index)
+        while self._peek() == "AND":
+            self.position += 1
+            result = np.intersect1d(result, self._not(index), assume_unique=True)
+        return result
+
+    def _not(self, index: TagIndex) -> np.ndarray:
+        if self._peek() == "NOT":
+            self.position += 1
+            return np.setdiff1d(index.all_ids(), self._not(index), assume_unique=True)
+        return self._atom(index)
+
+    def _atom(self, index: TagIndex) -> np.ndarray:
+        if self.position >= len(self.tokens):
+            raise ValueError("Tag query ended unexpectedly")
+        token, is_operator = self.tokens[self.position]
+        self.position += 1
+        if not is_operator:
+            return index.postings(token)
+        if token == "(":
+            result = self._or(index)
+            if self._peek() != ")":
+                raise ValueError("Missing ')' in tag query")
+            self.position += 1
+            return result
+        raise ValueError(f"Unexpected {token!r} in tag query")
+
+
+def open_index(data_dir: str, refresh: bool) -> TagIndex:
+    from dataset import DatasetDirectory  # pylint: disable=import-outside-toplevel
+
+    dataset = DatasetDirectory(data_dir, lazy=True)
+    index = dataset.tag_index if dataset.tag_index is not None else TagIndex(data_dir)
+    if refresh:
+        reindexed = index.refresh(dataset)
+        if reindexed:
+            typer.echo(f"Reindexed {reindexed} changed images")
+            index.save()
+    return index
+
+
+@app.command()
+def build(
+    data_dir: str = typer.Argument(..., help="Dataset directory to index"),
+    full: bool = typer.Option(False, help="Reindex every image, not just those whose metadata changed"),
+) -> None:
+    """Build (or update) a dataset's tag index."""
+    from dataset import DatasetDirectory  # pylint: disable=import-outside-toplevel
+
+    dataset = DatasetDirectory(data_dir)
+    index = dataset.tag_index if dataset.tag_index is not None else TagIndex(data_dir)
+    reindexed = index.refresh(dataset, full=full)
+    index.save()
+    typer.echo(f"Indexed {len(index.ids)} images ({reindexed} reindexed) with {len(index.counts())} distinct tags")
+
+
+@app.command()
+def top(
+    data_dir: str = typer.Argument(..., help="Dataset directory"),
+    k: int = typer.Option(50, "-k", help="Number of tags to list"),
+    refresh: bool = typer.Option(True, help="Reindex images whose metadata changed before answering"),
+) -> None:
+    """List the most common tags and how many images have each."""
+    index = open_index(data_dir, refresh)
+    total = len(index.ids)
+    for tag, count in index.top(k):
+        typer.echo(f"{count:>8} ({count / total * 100 if total else 0.0:5.1f}%)  {tag}")
+
+
+@app.command()
+def query(
+    data_dir: str = typer.Argument(..., help="Dataset directory"),
+    expression: str = typer.Argument(..., help="Tag query, e.g. \"techwear AND NOT 'low quality'\""),
+    count: bool = typer.Option(False, "--count", "-c", help="Only print the number of matching images"),
+    refresh: bool = typer.Option(True, help="Reindex images whose metadata changed before answering"),
+) -> None:
+    """List the images matching a boolean tag query."""
+    index = open_index(data_dir, refresh)
+    try:
+        matches = list(index.query(expression))
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from e
+    if count:
+        typer.echo(len(matches))
+        return
+    for path in matches:
+        typer.echo(index.root / path)
+
+
+if __name__ == "__main__":
+    app()
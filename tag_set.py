@@ -0,0 +1,82 @@
+"""Container for an image's tags."""
+
+from collections.abc import MutableSet
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+
+class TagVocabulary:
+    """Shared pool of tag strings, so images with the same tag all reference a single copy of the string."""
+
+    def __init__(self):
+        self._tags: Dict[str, str] = {}
+
+    def intern(self, tag: str) -> str:
+        return self._tags.setdefault(tag, tag)
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+
+DEFAULT_VOCABULARY = TagVocabulary()
+
+
+class TagSet(MutableSet):
+    """Insertion-ordered set of tags, with O(1) membership checks, adds and removals.
+
+    Behaves like the list of tags it replaces where it matters (iteration order, `append`, comparing equal to a list
+    of the same tags in the same order), and is stored as that list.
+
+    `listener`, if given, is called with each tag added (`True`) or removed (`False`).
+    """
+
+    __slots__ = ("_tags", "vocabulary", "listener")
+
+    def __init__(
+        self,
+        tags: Iterable[str] = (),
+        vocabulary: Optional[TagVocabulary] = None,
+        listener: Optional[Callable[[str, bool], None]] = None,
+    ):
+        self.vocabulary = vocabulary if vocabulary is not None else DEFAULT_VOCABULARY
+        self._tags: Dict[str, None] = dict.fromkeys(map(self.vocabulary.intern, tags))
+        self.listener = listener
+
+    def __contains__(self, tag: Any) -> bool:
+        return tag in self._tags
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tags)
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def add(self, tag: str) -> None:
+        if tag not in self._tags:
+            self._tags[self.vocabulary.intern(tag)] = None
+            if self.listener is not None:
+                self.listener(tag, True)
+
+    append = add
+
+    def discard(self, tag: str) -> None:
+        if tag in self._tags:
+            del self._tags[tag]
+            if self.listener is not None:
+                self.listener(tag, False)
+
+    def update(self, tags: Iterable[str]) -> None:
+        for tag in tags:
+            self.add(tag)
+
+    def to_list(self) -> List[str]:
+        return list(self._tags)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (TagSet, list, tuple)):
+            return self.to_list() == list(other)
+        return super().__eq__(other)
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"TagSet({self.to_list()!r})"
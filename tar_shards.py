@@ -0,0 +1,123 @@
+"""
+Packing a dataset into WebDataset-style tar shards, so training can stream large sequential reads instead of opening
+a small image and caption file per sample.
+
+Each sample is stored as consecutive `<key>.<ext>` (image), `<key>.txt` (caption) and `<key>.json` (selected
+metadata) members. Samples are assigned to shards up front (optionally shuffled), so shards are written in parallel,
+and a `shards.json` index lists each shard's sample count, size and SHA-256.
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List
+
+import tqdm
+
+from metadata_store import atomic_write, json_default
+
+SHARD_INDEX = "shards.json"
+SHARD_PATTERN = "shard-{:06d}.tar"
+# Rough size of a sample's tar headers and caption/metadata members, for planning shard sizes
+SAMPLE_OVERHEAD = 2048
+
+
+@dataclass
+class Sample:
+    key: str
+    image_path: Path
+    caption: str
+    metadata: Dict[str, Any]
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it, so shards don't have to be read back."""
+
+    def __init__(self, file: io.BufferedWriter):
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+
+def plan_shards(samples: List[Sample], max_bytes: int, max_samples: int) -> List[List[Sample]]:
+    """Splits samples into consecutive shards of at most `max_bytes` (roughly) and `max_samples` samples."""
+    shards: List[List[Sample]] = [[]]
+    shard_bytes = 0
+    for sample in samples:
+        size = os.stat(sample.image_path).st_size + SAMPLE_OVERHEAD
+        if shards[-1] and (shard_bytes + size > max_bytes or len(shards[-1]) >= max_samples):
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(sample)
+        shard_bytes += size
+    return shards if shards[0] else []
+
+
+def add_member(tar: tarfile.TarFile, name: str, data: bytes, mtime: float) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(mtime)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shard(samples: List[Sample], path: Path) -> Dict[str, Any]:
+    """Writes samples to a tar shard, returning its entry for the shard index."""
+    with atomic_write(path, "wb") as f:
+        writer = HashingWriter(f)
+        with tarfile.open(fileobj=writer, mode="w|", format=tarfile.USTAR_FORMAT) as tar:  # type: ignore[arg-type]
+            for sample in samples:
+                mtime = os.stat(sample.image_path).st_mtime
+                info = tar.gettarinfo(str(sample.image_path), f"{sample.key}{sample.image_path.suffix.lower()}")
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                with open(sample.image_path, "rb") as image_file:
+                    tar.addfile(info, image_file)
+                add_member(tar, f"{sample.key}.txt", sample.caption.encode(), mtime)
+                metadata = json.dumps(sample.metadata, default=json_default)
+                add_member(tar, f"{sample.key}.json", metadata.encode(), mtime)
+    return {"name": path.name, "samples": len(samples), "bytes": writer.size, "sha256": writer.hash.hexdigest()}
+
+
+def write_shards(
+    samples: List[Sample],
+    output_dir: str,
+    max_bytes: int,
+    max_samples: int,
+    workers: int = 8,
+    shuffle: bool = False,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Writes samples to tar shards in `output_dir` from a thread pool, along with the shard index.
+
+    Shards left over from an earlier export with more shards are deleted.
+    """
+    if shuffle:
+        samples = list(samples)
+        random.Random(seed).shuffle(samples)
+    shards = plan_shards(samples, max_bytes, max_samples)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    paths = [Path(output_dir) / SHARD_PATTERN.format(i) for i in range(len(shards))]
+    with ThreadPoolExecutor(workers) as executor:
+        entries = list(tqdm.tqdm(executor.map(write_shard, shards, paths), total=len(shards), unit="shards"))
+
+    stale = len(shards)
+    while (stale_path := Path(output_dir) / SHARD_PATTERN.format(stale)).exists():
+        stale_path.unlink()
+        stale += 1
+
+    index = {"samples": sum(entry["samples"] for entry in entries), "shards": entries}
+    with atomic_write(Path(output_dir) / SHARD_INDEX) as f:
+        json.dump(index, f, indent=2)
+    return entries